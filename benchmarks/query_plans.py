@@ -0,0 +1,122 @@
+"""
+Query plans and timings of the hot queries before and after the index migrations.
+
+    python benchmarks/query_plans.py --posts 200000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+
+root = Path(tempfile.mkdtemp())
+os.environ.setdefault('TELEGRAM_TOKEN', 'benchmark')
+os.environ.setdefault('STORAGE_PATH', str(root))
+os.environ['DB_PATH'] = str(root / 'db.sqlite3')
+
+from sqlalchemy import func, select, text, tuple_  # noqa: E402
+
+from subscriber.base import make_engine  # noqa: E402
+from subscriber.migrations import migrate  # noqa: E402
+from subscriber.models import Base, ChatPost, ChatPostState, Outbox, PostTable, SourceTable  # noqa: E402
+
+
+def queries(message_id: str, now: datetime):
+    ranked = select(
+        PostTable.source_id, PostTable.identifier,
+        func.row_number().over(partition_by=PostTable.source_id, order_by=PostTable.id.desc()).label('rank'),
+    ).subquery()
+    first = select(func.min(PostTable.created)).where(PostTable.source_id == SourceTable.id).scalar_subquery()
+    sources = select(SourceTable.id.label('source_id'), first.label('first')).cte('sources').prefix_with('MATERIALIZED')
+    return {
+        'keep/delete': select(ChatPost).where(ChatPost.message_id == message_id).order_by(ChatPost.id),
+        'list_deadlines': select(ChatPost.deadline, ChatPost.id).where(
+            (ChatPost.state == ChatPostState.Posted) & (tuple_(ChatPost.deadline, ChatPost.id) > (now, 0))
+        ).order_by(ChatPost.deadline, ChatPost.id).limit(1000),
+        'list_sources_and_posts': select(ranked.c.source_id, ranked.c.identifier).where(ranked.c.rank <= 100),
+        'get_post_rates': select(sources.c.source_id, func.count(PostTable.id)).join(
+            PostTable, (PostTable.source_id == sources.c.source_id) & (PostTable.created >= now - timedelta(days=30)),
+            isouter=True,
+        ).group_by(sources.c.source_id),
+        'claim_outbox': select(Outbox.id).where(
+            (Outbox.destination == 'Telegram') & Outbox.claimed.is_(None)
+        ).order_by(Outbox.id).limit(100),
+    }
+
+
+def fill(connection, sources: int, chats: int, posts: int):
+    now = datetime.utcnow()
+    connection.execute(Base.metadata.tables['Chat'].insert(), [
+        dict(id=i, identifier=str(i), type='Telegram') for i in range(1, chats + 1)
+    ])
+    connection.execute(Base.metadata.tables['Source'].insert(), [
+        dict(id=i, type='RSS', name=str(i), url=f'https://example.com/{i}', update_url=f'https://example.com/{i}/rss')
+        for i in range(1, sources + 1)
+    ])
+    connection.execute(PostTable.__table__.insert(), [
+        dict(
+            id=i, source_id=random.randint(1, sources), identifier=str(i), url=f'https://example.com/post/{i}',
+            created=now - timedelta(days=random.uniform(0, 365)),
+        ) for i in range(1, posts + 1)
+    ])
+    connection.execute(ChatPost.__table__.insert(), [
+        dict(
+            chat_id=random.randint(1, chats), post_id=i, message_id=str(i),
+            state=random.choice([ChatPostState.Posted, ChatPostState.Posted, ChatPostState.Keeping]).name,
+            deadline=now + timedelta(seconds=random.randint(-3600, 7 * 24 * 3600)),
+        ) for i in range(1, posts + 1)
+    ])
+    connection.execute(Outbox.__table__.insert(), [
+        dict(destination='Telegram', chat_id=random.randint(1, chats), post_id=i)
+        for i in range(1, posts + 1, 10)
+    ])
+
+
+def report(engine, title: str, repeats: int, posts: int):
+    print(f'# {title}')
+    now = datetime.utcnow()
+    with engine.connect() as connection:
+        for name, query in queries(str(random.randint(1, posts)), now).items():
+            compiled = query.compile(engine, compile_kwargs={'literal_binds': True})
+            plan = connection.execute(text(f'EXPLAIN QUERY PLAN {compiled}')).all()
+            start = time.perf_counter()
+            for _ in range(repeats):
+                connection.execute(query).all()
+            elapsed = (time.perf_counter() - start) / repeats * 1000
+
+            print(f'{name}: {elapsed:.3f} ms')
+            for row in plan:
+                print('   ', row[-1])
+        print()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sources', type=int, default=1000)
+    parser.add_argument('--chats', type=int, default=100)
+    parser.add_argument('--posts', type=int, default=100_000)
+    parser.add_argument('--repeats', type=int, default=10)
+    args = parser.parse_args()
+
+    random.seed(0)
+    engine = make_engine()
+    # a database from before the indexes were added
+    with engine.begin() as connection:
+        Base.metadata.create_all(connection)
+        for name in [
+            'ix_ChatPost_message_id', 'ix_ChatPost_state_deadline', 'ix_Post_source_id_id', 'ix_Post_source_id_created'
+        ]:
+            connection.execute(text(f'DROP INDEX "{name}"'))
+        connection.execute(text('PRAGMA user_version = 1'))
+        fill(connection, args.sources, args.chats, args.posts)
+
+    report(engine, 'before', args.repeats, args.posts)
+    migrate(engine)
+    report(engine, 'after', args.repeats, args.posts)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,38 @@
+import asyncio
 import contextlib
-from functools import cache
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache, partial, wraps
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.exc import IntegrityError, NoResultFound
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import Session, sessionmaker
 
+from .metrics import DB_SECONDS
 from .settings import config
 
 
 # TODO: refactor this
 @cache
 def make_engine():
-    return create_engine(f'sqlite:///{config.db_path}')
+    engine = create_engine(
+        f'sqlite:///{config.db_path}', pool_size=config.db_pool_size, max_overflow=config.db_max_overflow,
+    )
+    event.listen(engine, 'connect', _set_pragmas)
+    return engine
+
+
+def _set_pragmas(connection, record):
+    cursor = connection.cursor()
+    # WAL lets the readers work alongside a writer
+    cursor.execute(f'PRAGMA journal_mode = {config.db_journal_mode}')
+    cursor.execute(f'PRAGMA synchronous = {config.db_synchronous}')
+    cursor.execute(f'PRAGMA cache_size = {config.db_cache_size:d}')
+    cursor.execute(f'PRAGMA mmap_size = {config.db_mmap_size:d}')
+    cursor.execute(f'PRAGMA busy_timeout = {config.db_busy_timeout:d}')
+    cursor.execute('PRAGMA foreign_keys = ON')
+    cursor.close()
 
 
 @cache
@@ -20,6 +40,25 @@ def session_maker():
     return sessionmaker(autocommit=False, autoflush=False, bind=make_engine())
 
 
+@cache
+def db_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(config.db_threads, thread_name_prefix='db')
+
+
+def in_db_thread(func):
+    """ Turns a blocking database function into a coroutine that runs in the dedicated database thread """
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(db_executor(), partial(func, *args, **kwargs))
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - start, func.__name__)
+
+    return wrapper
+
+
 @contextlib.contextmanager
 def db():
     session = session_maker()()
@@ -1,30 +1,35 @@
 import logging
+from collections import defaultdict
 from datetime import datetime, timedelta
-from typing import Dict, Iterable, Sequence
+from typing import Dict, Sequence
 
-from sqlalchemy.orm import Session
+from sqlalchemy import exists, func, literal, select, tuple_
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session, aliased
 
-from .base import db, get_or_create
+from .base import db, get_or_create, in_db_thread
 from .models import (
-    ChatPost, ChatPostState, ChatTable, ChatToSource, File, FileTable, Identifier, Post, PostTable, Source, SourceTable
+    ChatPost, ChatPostState, ChatTable, ChatToSource, File, FileTable, Identifier, Outbox, Post, PostTable, Source,
+    SourceTable, Validators
 )
 from .sources import ChannelData, PostUpdate
-from .utils import store_base64
 
 
 logger = logging.getLogger(__name__)
 
 
+@in_db_thread
 def subscribe(chat_id: Identifier, chat_type: str, source_type: str, url: str, data: ChannelData):
     with db() as session:
         chat, _ = get_or_create(session, ChatTable, identifier=chat_id, type=chat_type)
         source, _ = get_or_create(
-            session, SourceTable, defaults={'url': url, 'image': wrap_base64_to_hash(session, data.image)},
+            session, SourceTable, defaults={'url': url, 'image': wrap_digest(session, data.image)},
             update_url=data.update_url, name=data.name, type=source_type,
         )
         get_or_create(session, ChatToSource, chat_id=chat.id, source_id=source.id)
 
 
+@in_db_thread
 def unsubscribe(chat_id: str, source_pk: int):
     with db() as session:
         return session.query(ChatToSource).filter(
@@ -32,104 +37,316 @@ def unsubscribe(chat_id: str, source_pk: int):
         ).delete(synchronize_session=False)
 
 
+@in_db_thread
 def list_chat_sources(chat_id: Identifier, chat_type: str) -> Sequence[Source]:
     with db() as session:
         chat, _ = get_or_create(session, ChatTable, identifier=str(chat_id), type=chat_type)
         return [Source(pk=c.id, name=c.name, type=c.type, update_url=c.update_url) for c in chat.sources]
 
 
+@in_db_thread
 def list_all_sources() -> list[tuple[bool, Source]]:
     with db() as session:
-        sources = session.query(SourceTable).all()
+        has_posts = exists().where(PostTable.source_id == SourceTable.id)
+        rows = session.execute(select(
+            has_posts, SourceTable.id, SourceTable.name, SourceTable.type, SourceTable.update_url,
+            SourceTable.etag, SourceTable.last_modified,
+        ))
         return [
             (
-                session.query(PostTable).where(PostTable.source == s).first() is not None,
-                Source(pk=s.id, name=s.name, type=s.type, update_url=s.update_url),
-            ) for s in sources
+                notify,
+                Source(
+                    pk=pk, name=name, type=type_, update_url=update_url,
+                    validators=Validators(etag=etag, last_modified=last_modified),
+                ),
+            ) for notify, pk, name, type_, update_url, etag, last_modified in rows
         ]
 
 
-def list_sources_and_posts() -> Dict[int, set]:
+@in_db_thread
+def update_validators(source_pk: int, validators: Validators):
     with db() as session:
-        sources = session.query(SourceTable).all()
-        return {
-            s.id: {
-                x[0] for x in session.query(PostTable.identifier).where(
-                    PostTable.source == s).order_by(PostTable.id.desc()).limit(100)
-            }
-            for s in sources
-        }
+        session.query(SourceTable).where(SourceTable.id == source_pk).update({
+            SourceTable.etag: validators.etag, SourceTable.last_modified: validators.last_modified,
+        })
 
 
-# TODO: message id is clearly not enough
-def keep(message_id: Identifier):
+@in_db_thread
+def list_sources_and_posts(limit: int = 100) -> Dict[int, set]:
     with db() as session:
-        post = session.query(ChatPost).where(ChatPost.message_id == message_id).first()
-        if post is not None:
+        ranked = select(
+            PostTable.source_id, PostTable.identifier,
+            func.row_number().over(partition_by=PostTable.source_id, order_by=PostTable.id.desc()).label('rank'),
+        ).subquery()
+        rows = session.execute(select(ranked.c.source_id, ranked.c.identifier).where(ranked.c.rank <= limit))
+
+        result = defaultdict(set)
+        for pk, identifier in rows:
+            result[pk].add(identifier)
+        return dict(result)
+
+
+@in_db_thread
+def get_post_rates(window: timedelta, initial: timedelta = timedelta(minutes=10)) -> Dict[int, float]:
+    """
+    The number of posts per second for each source during the last `window`.
+    The posts found during the first `initial` period of a source are not counted: they are the source's history
+    """
+    now = datetime.utcnow()
+    with db() as session:
+        # a lookup in `ix_Post_source_id_created` for each source instead of grouping the whole table.
+        # Materialized, otherwise the lookup is repeated for each post in the window
+        first = select(func.min(PostTable.created)).where(PostTable.source_id == SourceTable.id).scalar_subquery()
+        sources = select(
+            SourceTable.id.label('source_id'), first.label('first')
+        ).cte('sources').prefix_with('MATERIALIZED')
+        query = select(sources.c.source_id, sources.c.first, func.count(PostTable.id)).join(
+            PostTable, (PostTable.source_id == sources.c.source_id) & (PostTable.created >= now - window) & (
+                func.julianday(PostTable.created) - func.julianday(sources.c.first) > initial / timedelta(days=1)
+            ), isouter=True,
+        ).where(sources.c.first.is_not(None)).group_by(sources.c.source_id, sources.c.first)
+
+        rates = {}
+        for pk, start, count in session.execute(query):
+            # young sources have a shorter history, but at least a day
+            span = min(window, max(now - start, timedelta(days=1)))
+            rates[pk] = count / span.total_seconds()
+        return rates
+
+
+@in_db_thread
+def keep(chat_id: Identifier, message_id: Identifier, index: int | None = None):
+    """ Keep all the posts in the message, or only the `index`-th one (starting from 1) in a digest """
+    with db() as session:
+        posts = session.query(ChatPost).where(_chat_message(chat_id, message_id)).order_by(ChatPost.id).all()
+        if index is not None:
+            posts = posts[index - 1:index]
+        for post in posts:
             post.state = ChatPostState.Keeping
 
 
-def delete(message_id: Identifier):
+@in_db_thread
+def delete(chat_id: Identifier, message_id: Identifier):
     with db() as session:
-        post = session.query(ChatPost).where(ChatPost.message_id == message_id).first()
-        if post is not None:
-            post.state = ChatPostState.Deleted
+        session.query(ChatPost).where(_chat_message(chat_id, message_id)).update({
+            ChatPost.state: ChatPostState.Deleted
+        }, synchronize_session=False)
+
 
+@in_db_thread
+def set_digest(chat_id: Identifier, chat_type: str, window: int | None):
+    with db() as session:
+        chat, _ = get_or_create(session, ChatTable, identifier=str(chat_id), type=chat_type)
+        chat.digest = window
 
-def save_post(source: Source, update: PostUpdate, notify: bool):
-    source_id = source.pk
 
+@in_db_thread
+def save_posts(updates: Sequence[tuple[Source, PostUpdate, bool]]) -> set[str]:
+    """
+    Save a batch of updates in a single transaction, the already existing ones are ignored.
+    The new posts are added to the outbox of each subscribed chat. Returns the destinations with new outbox entries
+    """
     with db() as session:
-        if session.query(PostTable).where(
-                (PostTable.identifier == update.id) & (PostTable.source_id == source_id)
-        ).first() is not None:
-            logger.info('Ignoring an existing update %s for %s (%s)', update.id, source.name, source.type)
-            return
+        digests = {update.content.image for _, update, _ in updates if update.content.image is not None}
+        images = {}
+        if digests:
+            session.execute(insert(FileTable).values([{'internal': x} for x in digests]).on_conflict_do_nothing())
+            images = dict(session.execute(
+                select(FileTable.internal, FileTable.id).where(FileTable.internal.in_(digests))
+            ).all())
 
-        post_entry = PostTable(
-            identifier=update.id, source_id=source_id, url=update.url, title=update.content.title or '',
-            image=wrap_base64_to_hash(session, update.content.image), description=update.content.description or '',
-        )
-        session.add(post_entry)
-        session.flush()
-        # prepare chat posts to be sent to subscribers
-        if notify:
-            source_entry = session.query(SourceTable).where(SourceTable.id == source_id).first()
-            image = post_entry.image or source_entry.image
-            post = Post(
-                title=post_entry.title, description=post_entry.description, url=post_entry.url,
-                image=None if image is None else File(internal=image.internal, telegram=image.telegram),
+        inserted = session.execute(insert(PostTable).values([
+            dict(
+                identifier=update.id, source_id=source.pk, url=update.url, title=update.content.title or '',
+                description=update.content.description or '', image_id=images.get(update.content.image),
+            ) for source, update, _ in updates
+        ]).on_conflict_do_nothing().returning(PostTable.source_id, PostTable.identifier, PostTable.id)).all()
+        inserted = {(source_id, identifier): pk for source_id, identifier, pk in inserted}
+
+        destinations = set()
+        for source, update, notify in updates:
+            post_pk = inserted.pop((source.pk, update.id), None)
+            if post_pk is None:
+                logger.info('Ignoring an existing update %s for %s (%s)', update.id, source.name, source.type)
+                continue
+            if not notify:
+                continue
+
+            destinations.update(session.scalars(
+                insert(Outbox).from_select(
+                    [Outbox.destination, Outbox.chat_id, Outbox.post_id],
+                    select(ChatTable.type, ChatTable.id, literal(post_pk))
+                    .join(ChatToSource, ChatTable.id == ChatToSource.chat_id)
+                    .where(ChatToSource.source_id == source.pk)
+                ).returning(Outbox.destination)
+            ))
+
+        return destinations
+
+
+@in_db_thread
+def claim_outbox(destination: str, limit: int) -> list[tuple[Identifier, int, int, int | None, datetime, Post]]:
+    """ Mark the oldest outbox entries of the destination as being sent. Returns the chat posts to send """
+    with db() as session:
+        ids = select(Outbox.id).where(
+            (Outbox.destination == destination) & Outbox.claimed.is_(None)
+            & (Outbox.retry_at.is_(None) | (Outbox.retry_at <= datetime.utcnow()))
+        ).order_by(Outbox.id).limit(limit)
+        claimed = sorted(session.execute(
+            Outbox.__table__.update().where(Outbox.id.in_(ids)).values(claimed=datetime.utcnow())
+            .returning(Outbox.id, Outbox.chat_id, Outbox.post_id)
+        ))
+        if not claimed:
+            return []
+
+        chats = {pk: (identifier, digest) for pk, identifier, digest in session.execute(
+            select(ChatTable.id, ChatTable.identifier, ChatTable.digest)
+            .where(ChatTable.id.in_({chat for _, chat, _ in claimed}))
+        )}
+        # the posts are shared between chats
+        posts, created = {}, {}
+        own, fallback = aliased(FileTable), aliased(FileTable)
+        for pk, created[pk], title, description, url, *images in session.execute(
+                select(
+                    PostTable.id, PostTable.created, PostTable.title, PostTable.description, PostTable.url,
+                    own.internal, own.telegram, fallback.internal, fallback.telegram,
+                )
+                .join(SourceTable, SourceTable.id == PostTable.source_id)
+                .outerjoin(own, own.id == PostTable.image_id)
+                .outerjoin(fallback, fallback.id == SourceTable.image_id)
+                .where(PostTable.id.in_({post for _, _, post in claimed}))
+        ):
+            # fall back to the source image
+            internal, telegram = images[:2] if images[0] is not None else images[2:]
+            posts[pk] = Post(
+                title=title or '', description=description or '', url=url,
+                image=None if internal is None else File(internal=internal, telegram=telegram),
             )
-            for chat in source_entry.chats:
-                yield chat.identifier, chat.type, chat.id, post_entry.id, post
+
+        return [
+            (chats[chat][0], chat, post, chats[chat][1], created[post], posts[post]) for _, chat, post in claimed
+        ]
 
 
-def save_chat_post(chat_pk: int, post_pk: int, message_id: Identifier):
+@in_db_thread
+def ack_outbox(chat_pk: int, post_pk: int):
+    with db() as session:
+        _ack_outbox(session, chat_pk, post_pk)
+
+
+@in_db_thread
+def retry_outbox(chat_pk: int, post_pk: int, delay: float, max_attempts: int) -> bool:
+    """
+    Return the entry to the outbox, to be sent again after `delay` seconds, doubled with each attempt.
+    Returns False if there are no attempts left, then the entry is removed
+    """
+    with db() as session:
+        entry = session.query(Outbox).where((Outbox.chat_id == chat_pk) & (Outbox.post_id == post_pk)).first()
+        if entry is None:
+            return False
+        if entry.attempts + 1 >= max_attempts:
+            session.delete(entry)
+            return False
+
+        entry.claimed = None
+        entry.retry_at = datetime.utcnow() + timedelta(seconds=delay * 2 ** entry.attempts)
+        entry.attempts += 1
+        return True
+
+
+@in_db_thread
+def reset_outbox():
+    """ Entries claimed before a restart were never sent """
+    with db() as session:
+        session.query(Outbox).where(Outbox.claimed.is_not(None)).update({Outbox.claimed: None})
+
+
+@in_db_thread
+def save_chat_post(chat_pk: int, post_pk: int, message_id: Identifier) -> tuple[datetime, int]:
+    """ Returns the deadline and the primary key of the chat post """
     # FIXME
     ten_years = 315_569_260
     with db() as session:
         chat = session.query(ChatTable).where(ChatTable.id == chat_pk).first()
         ttl = chat.ttl
         deadline = datetime.utcnow() + timedelta(seconds=ttl if ttl is not None else ten_years)
-        session.add(ChatPost(
+        chat_post = ChatPost(
             post_id=post_pk, chat_id=chat_pk, message_id=message_id, state=ChatPostState.Posted, deadline=deadline
-        ))
+        )
+        session.add(chat_post)
+        _ack_outbox(session, chat_pk, post_pk)
         session.flush()
+        return deadline, chat_post.id
 
 
-def get_old_posts() -> Iterable[tuple[str, Identifier, Identifier]]:
+@in_db_thread
+def save_telegram_file(internal: str, file_id: Identifier):
     with db() as session:
-        outdated = session.query(ChatPost).where(ChatPost.state == ChatPostState.Posted).where(
-            ChatPost.deadline < datetime.utcnow()
+        session.query(FileTable).where(
+            (FileTable.internal == internal) & FileTable.telegram.is_(None)
+        ).update({FileTable.telegram: file_id})
+
+
+@in_db_thread
+def list_deadlines(after: tuple[datetime, int] | None, limit: int) -> list[tuple[datetime, int]]:
+    """ The (deadline, primary key) of the next `limit` posted chat posts, ordered by deadline """
+    with db() as session:
+        query = select(ChatPost.deadline, ChatPost.id).where(ChatPost.state == ChatPostState.Posted)
+        if after is not None:
+            query = query.where(tuple_(ChatPost.deadline, ChatPost.id) > tuple_(*after))
+        rows = session.execute(query.order_by(ChatPost.deadline, ChatPost.id).limit(limit))
+        return [(deadline, pk) for deadline, pk in rows]
+
+
+@in_db_thread
+def expire_posts(ids: Sequence[int]) -> list[tuple[str, Identifier, Identifier]]:
+    """
+    Returns the messages to remove, for those chat posts that are still posted and outdated.
+    All the posts in these messages are marked as deleted, so that each message is removed only once
+    """
+    with db() as session:
+        outdated = session.execute(
+            select(ChatPost.id, ChatPost.chat_id, ChatPost.message_id, ChatTable.type, ChatTable.identifier)
+            .join(ChatTable, ChatTable.id == ChatPost.chat_id)
+            .where(ChatPost.id.in_(ids) & (ChatPost.state == ChatPostState.Posted))
+            .where(ChatPost.deadline <= datetime.utcnow())
         ).all()
-        for chat_post in outdated:
-            yield chat_post.chat.type, chat_post.chat.identifier, chat_post.message_id
+        # a digest is not removed while any of its posts is kept
+        kept = set(session.execute(select(ChatPost.chat_id, ChatPost.message_id).where(
+            (ChatPost.state == ChatPostState.Keeping) & ChatPost.message_id.in_({x.message_id for x in outdated})
+        )).all())
+
+        result, hidden = {}, []
+        for pk, chat_pk, message_id, chat_type, chat_id in outdated:
+            if (chat_pk, message_id) in kept:
+                hidden.append(pk)
+            else:
+                result[chat_pk, message_id] = chat_type, chat_id, message_id
+
+        if hidden:
+            session.query(ChatPost).where(ChatPost.id.in_(hidden)).update({ChatPost.state: ChatPostState.Deleted})
+        if result:
+            # the other posts of a digest have slightly later deadlines
+            session.query(ChatPost).where(
+                (ChatPost.state == ChatPostState.Posted) & tuple_(ChatPost.chat_id, ChatPost.message_id).in_(result)
+            ).update({ChatPost.state: ChatPostState.Deleted}, synchronize_session=False)
+        return list(result.values())
+
+
+def _chat_message(chat_id: Identifier, message_id: Identifier):
+    # message ids are unique only within a chat
+    return (ChatPost.message_id == message_id) & ChatPost.chat.has(ChatTable.identifier == chat_id)
+
+
+def _ack_outbox(session: Session, chat_pk: int, post_pk: int):
+    session.query(Outbox).where(
+        (Outbox.chat_id == chat_pk) & (Outbox.post_id == post_pk)
+    ).delete(synchronize_session=False)
 
 
-def wrap_base64_to_hash(session: Session, image):
-    if image is None:
+def wrap_digest(session: Session, digest: str | None):
+    if digest is None:
         return
 
-    digest = store_base64(image)
     file, _ = get_or_create(session, FileTable, internal=digest)
     return file
@@ -1,3 +1,3 @@
-from .interface import Destination
+from .interface import Destination, Throttled
 from .slack_webhook import SlackWebhook
 from .tg import Telegram
@@ -1,7 +1,10 @@
+import asyncio
 import logging
 from typing import Sequence
 
-from ..crud import keep, list_chat_sources, subscribe, unsubscribe
+import aiohttp
+
+from ..crud import keep, list_chat_sources, set_digest, subscribe, unsubscribe
 from ..models import Identifier, Post, Source
 from ..sources import ChannelAdapter, VisibleError
 
@@ -9,6 +12,10 @@ from ..sources import ChannelAdapter, VisibleError
 logger = logging.getLogger(__name__)
 
 
+class Throttled(Exception):
+    """ The chat hit the flood limits. The message must be sent again when the chat is ready """
+
+
 class Destination:
     @classmethod
     def name(cls):
@@ -25,7 +32,7 @@ class Destination:
             if data.url is not None:
                 url = data.url
 
-            subscribe(chat_id, cls.name(), adapter.name(), url, data)
+            await subscribe(chat_id, cls.name(), adapter.name(), url, data)
             return 'Done'
 
         except VisibleError as e:
@@ -37,19 +44,31 @@ class Destination:
 
     @staticmethod
     async def unsubscribe(chat_id: Identifier, source_id: Identifier):
-        unsubscribe(chat_id, int(source_id))
+        await unsubscribe(chat_id, int(source_id))
 
     @classmethod
     async def list(cls, chat_id: Identifier) -> Sequence[Source]:
-        return list_chat_sources(chat_id, cls.name())
+        return await list_chat_sources(chat_id, cls.name())
 
     @staticmethod
-    async def keep(message_id: Identifier):
-        keep(message_id)
+    async def keep(chat_id: Identifier, message_id: Identifier, index: int | None = None):
+        await keep(chat_id, message_id, index)
+
+    @classmethod
+    async def set_digest(cls, chat_id: Identifier, window: int | None):
+        await set_digest(chat_id, cls.name(), window)
 
     async def save_image(self, hash_: str, identifier: str):
         pass
 
+    def ready_at(self, chat_id: Identifier) -> float:
+        """ The `time.monotonic()` when the chat can receive the next message, 0 if it can right away """
+        return 0
+
+    def transient(self, error: Exception) -> bool:
+        """ Whether the failed delivery can succeed later """
+        return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError))
+
     async def __aenter__(self):
         await self.start()
 
@@ -67,5 +86,9 @@ class Destination:
     async def notify(self, chat_id: Identifier, post: Post) -> Identifier | None:
         pass
 
+    async def notify_digest(self, chat_id: Identifier, posts: Sequence[Post]) -> Sequence[Identifier | None]:
+        """ Send several posts at once. Returns the message id for each post """
+        return [await self.notify(chat_id, post) for post in posts]
+
     async def remove(self, chat_id: Identifier, message_id: Identifier):
         pass
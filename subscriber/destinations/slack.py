@@ -0,0 +1,34 @@
+from functools import lru_cache
+
+from ..models import Post
+
+
+@lru_cache(1024)
+def render_blocks(post: Post) -> list[dict]:
+    """ Slack blocks for the post. The result is shared between chats and must not be changed """
+    parts = []
+    if post.title:
+        parts.append({
+            'type': 'header',
+            'text': {
+                'type': 'plain_text',
+                'text': post.title
+            }
+        })
+    if post.description:
+        parts.append({
+            'type': 'section',
+            'text': {
+                'type': 'mrkdwn',
+                'text': post.description,
+            }
+        })
+
+    parts.append({
+        'type': 'section',
+        'text': {
+            'type': 'mrkdwn',
+            'text': post.url,
+        }
+    })
+    return parts
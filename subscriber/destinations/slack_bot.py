@@ -6,6 +6,7 @@ from slack_sdk.web.async_client import AsyncWebClient
 
 from ..models import Identifier, Post
 from .interface import Destination
+from .slack import render_blocks
 
 
 logger = logging.getLogger(__name__)
@@ -28,33 +29,7 @@ class SlackBot(Destination):
         await respond(await self.subscribe(channel_id, url))
 
     async def notify(self, chat_id: Identifier, post: Post) -> Identifier | None:
-        parts = []
-        if post.title:
-            parts.append({
-                'type': 'header',
-                'text': {
-                    'type': 'plain_text',
-                    'text': post.title
-                }
-            })
-        if post.description:
-            parts.append({
-                'type': 'section',
-                'text': {
-                    'type': 'mrkdwn',
-                    'text': post.description,
-                }
-            })
-
-        parts.append({
-            'type': 'section',
-            'text': {
-                'type': 'mrkdwn',
-                'text': post.url,
-            }
-        })
-
-        response = await self.app.client.chat_postMessage(channel=chat_id, text=post.title, blocks=parts)
+        response = await self.app.client.chat_postMessage(channel=chat_id, text=post.title, blocks=render_blocks(post))
         return response['ts']
 
     async def remove(self, chat_id: Identifier, message_id: Identifier):
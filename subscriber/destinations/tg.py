@@ -1,18 +1,29 @@
+import asyncio
 import logging
+import time
 from contextlib import suppress
+from functools import lru_cache, partial
+from typing import Awaitable, Callable, Sequence
 from urllib.parse import quote_plus
 
 from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, Update
 from telegram.constants import ParseMode
-from telegram.error import TelegramError
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
 from telegram.ext import Application, CallbackContext, CallbackQueryHandler, CommandHandler, MessageHandler, filters
 
-from ..models import Identifier, Post
-from ..utils import URL_PATTERN, drop_prefix, storage_resolve
-from .interface import Destination
+from ..crud import delete, save_telegram_file
+from ..metrics import TELEGRAM_RETRIES
+from ..models import File, Identifier, Post
+from ..settings import config
+from ..utils import LRU, URL_PATTERN, TokenBucket, acquire_tokens, drop_prefix, storage_resolve
+from .interface import Destination, Throttled
 
 
 logger = logging.getLogger(__name__)
+NOTIFY_MARKUP = InlineKeyboardMarkup.from_row([
+    InlineKeyboardButton('Keep', callback_data='KEEP'),
+    InlineKeyboardButton('Dismiss', callback_data='DISMISS'),
+])
 
 
 class Telegram(Destination):
@@ -27,6 +38,8 @@ class Telegram(Destination):
         # delete sources
         app.add_handler(CommandHandler('delete', self._delete))
         app.add_handler(CallbackQueryHandler(self._delete_callback, pattern='DELETE'))
+        # digests
+        app.add_handler(CommandHandler('digest', self._digest))
         # message commands
         app.add_handler(CallbackQueryHandler(self._dismiss_callback, pattern='DISMISS'))
         app.add_handler(CallbackQueryHandler(self._keep, pattern='KEEP'))
@@ -35,6 +48,13 @@ class Telegram(Destination):
 
         self.app = app
         self.bot: Bot = app.bot
+        # digest -> file_id of the already uploaded images
+        self._file_ids = LRU(10_000)
+        # digest -> file_id of the images being uploaded right now
+        self._uploads: dict[str, asyncio.Future] = {}
+        # flood limits
+        self._global = TokenBucket(config.telegram_global_rate)
+        self._chats = LRU(10_000)
 
     # events
 
@@ -48,62 +68,123 @@ class Telegram(Destination):
         await self.app.stop()
         await self.app.shutdown()
 
-    # TODO: add throttling
     async def notify(self, chat_id: Identifier, post: Post) -> Identifier:
-        description = post.description
-        if len(description) > 3800:
-            description = description[:3800] + '...'
-        text = f'{post.title}\n{description}\n{post.url}'.strip()
-        if '<' in text:
-            text = quote_plus(text)
-        parse_mode = ParseMode.HTML
-        image = post.image
-
-        markup = InlineKeyboardMarkup.from_row([
-            InlineKeyboardButton('Keep', callback_data='KEEP'),
-            InlineKeyboardButton('Dismiss', callback_data='DISMISS'),
-        ])
-
-        if image is None:
-            message = await self.bot.send_message(
-                chat_id, text, reply_markup=markup, parse_mode=parse_mode,
-                disable_web_page_preview=bool(post.title or description),
-            )
-
-        elif image.telegram is None:
-            # TODO: need another adapter?
-            with open(storage_resolve(image.internal), 'rb') as img:
-                message = await self.bot.send_photo(
-                    chat_id, img, parse_mode=parse_mode, caption=text, reply_markup=markup
-                )
-                await self.save_image(image.internal, message.photo[0].file_id)
+        text, disable_preview = render(post)
+        if post.image is None:
+            message = await self._throttle(chat_id, partial(
+                self.bot.send_message, chat_id, text, reply_markup=NOTIFY_MARKUP, parse_mode=ParseMode.HTML,
+                disable_web_page_preview=disable_preview,
+            ))
 
         else:
-            message = await self.bot.send_photo(
-                chat_id, image.telegram, parse_mode=parse_mode, caption=text, reply_markup=markup
+            message = await self._send_photo(
+                chat_id, post.image, parse_mode=ParseMode.HTML, caption=text, reply_markup=NOTIFY_MARKUP
             )
 
         return str(message.message_id)
 
+    async def notify_digest(self, chat_id: Identifier, posts: Sequence[Post]) -> list[Identifier]:
+        # media groups can't have buttons, so the digest is a single text message with a Keep button for each post
+        buttons = [InlineKeyboardButton(f'Keep {i}', callback_data=f'KEEP:{i}') for i in range(1, len(posts) + 1)]
+        markup = InlineKeyboardMarkup([buttons[i:i + 5] for i in range(0, len(buttons), 5)] + [[
+            InlineKeyboardButton('Dismiss', callback_data='DISMISS')
+        ]])
+        message = await self._throttle(chat_id, partial(
+            self.bot.send_message, chat_id, render_digest(posts), reply_markup=markup, disable_web_page_preview=True,
+        ))
+        return [str(message.message_id)] * len(posts)
+
+    async def save_image(self, hash_: str, identifier: str):
+        self._file_ids[hash_] = identifier
+        await save_telegram_file(hash_, identifier)
+
+    def ready_at(self, chat_id: Identifier) -> float:
+        # the global limit applies to all the chats alike
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            return 0
+        delay = chat.delay()
+        return time.monotonic() + delay if delay > 0 else 0
+
+    def transient(self, error: Exception) -> bool:
+        # a bad request is a network error as well
+        return (isinstance(error, NetworkError) and not isinstance(error, BadRequest)) or super().transient(error)
+
+    async def _send_photo(self, chat_id: Identifier, image: File, **kwargs):
+        """ Each image is uploaded only once, the other chats receive its file_id """
+        internal = image.internal
+        file_id = image.telegram or self._file_ids.get(internal)
+        while file_id is None and internal in self._uploads:
+            # another chat is uploading the same image. If it fails - try again
+            file_id = await asyncio.shield(self._uploads[internal])
+
+        if file_id is not None:
+            return await self._throttle(chat_id, partial(self.bot.send_photo, chat_id, file_id, **kwargs))
+
+        async def send():
+            # the file is reopened on each retry
+            with open(storage_resolve(internal), 'rb') as img:
+                return await self.bot.send_photo(chat_id, img, **kwargs)
+
+        upload = self._uploads[internal] = asyncio.get_running_loop().create_future()
+        try:
+            message = await self._throttle(chat_id, send)
+            # the largest size
+            file_id = message.photo[-1].file_id
+            await self.save_image(internal, file_id)
+            return message
+
+        finally:
+            upload.set_result(file_id)
+            del self._uploads[internal]
+
+    async def _throttle(self, chat_id: Identifier, request: Callable[[], Awaitable]):
+        """
+        Make a request to the chat within the flood limits. Requests that hit the global limit are retried here,
+        the ones that hit the chat's limit raise `Throttled`
+        """
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            # group chats have negative ids
+            group = str(chat_id).startswith('-')
+            chat = self._chats[chat_id] = TokenBucket(
+                config.telegram_group_rate if group else config.telegram_chat_rate
+            )
+
+        while True:
+            # if the chat was idle, it's the global limit that was hit
+            idle = chat.full()
+            await acquire_tokens(self._global, chat)
+            try:
+                return await request()
+            except RetryAfter as e:
+                logger.warning('Flood limit for %s, retrying in %s seconds', chat_id, e.retry_after)
+                TELEGRAM_RETRIES.inc('global' if idle else 'chat')
+                if not idle:
+                    chat.pause(e.retry_after)
+                    raise Throttled(chat_id) from e
+                self._global.pause(e.retry_after)
+
     async def remove(self, chat_id: Identifier, message_id: Identifier):
         message_id = int(message_id)
         with suppress(TelegramError):
-            await self.bot.delete_message(chat_id, message_id)
+            await self._throttle(chat_id, partial(self.bot.delete_message, chat_id, message_id))
             return
 
         message = '<Deleted>'
         with suppress(TelegramError):
-            await self.bot.edit_message_text(message, chat_id, message_id)
+            await self._throttle(chat_id, partial(self.bot.edit_message_text, message, chat_id, message_id))
             return
         with suppress(TelegramError):
-            await self.bot.edit_message_media(
+            await self._throttle(chat_id, partial(
+                self.bot.edit_message_media,
                 # TODO: upload once
                 InputMediaPhoto('https://raster.shields.io/badge/-deleted-red'),
                 chat_id, message_id,
-            )
+            ))
             return
         with suppress(TelegramError):
-            await self.bot.edit_message_caption(chat_id, message_id, caption=message)
+            await self._throttle(chat_id, partial(self.bot.edit_message_caption, chat_id, message_id, caption=message))
             return
 
     # callbacks
@@ -111,10 +192,35 @@ class Telegram(Destination):
     async def _keep(self, update: Update, context: CallbackContext):
         query = update.callback_query
         message = query.message
-        await self.keep(str(message.message_id))
-        await message.edit_reply_markup(InlineKeyboardMarkup.from_button(
-            InlineKeyboardButton('Dismiss', callback_data='DISMISS')
-        ))
+        chat_id = str(message.chat.id)
+        _, _, index = query.data.partition(':')
+        if not index:
+            await self.keep(chat_id, str(message.message_id))
+            await message.edit_reply_markup(InlineKeyboardMarkup.from_button(
+                InlineKeyboardButton('Dismiss', callback_data='DISMISS')
+            ))
+            return
+
+        # a post in a digest
+        await self.keep(chat_id, str(message.message_id), int(index))
+        keyboard = [
+            [button for button in row if button.callback_data != query.data]
+            for row in message.reply_markup.inline_keyboard
+        ]
+        await message.edit_reply_markup(InlineKeyboardMarkup([row for row in keyboard if row]))
+
+    async def _digest(self, update: Update, context: CallbackContext):
+        message = update.message
+        chat_id = str(message.chat.id)
+        window = context.args[0].lower() if context.args else ''
+        if window in ('off', '0'):
+            await self.set_digest(chat_id, None)
+            await message.reply_text('New posts will be sent right away')
+        elif window.isdigit():
+            await self.set_digest(chat_id, int(window) * 60)
+            await message.reply_text(f'New posts will be grouped into digests every {window} minutes')
+        else:
+            await message.reply_text('Usage: /digest <minutes> or /digest off')
 
     async def _link(self, update: Update, context: CallbackContext):
         message = update.message
@@ -149,7 +255,15 @@ class Telegram(Destination):
 
     async def _dismiss_callback(self, update: Update, context: CallbackContext):
         message = update.callback_query.message
-        await self.remove(str(message.chat_id), str(message.message_id))
+        chat_id, message_id = str(message.chat_id), str(message.message_id)
+        while True:
+            try:
+                await self.remove(chat_id, message_id)
+                break
+            except Throttled:
+                await asyncio.sleep(self.ready_at(chat_id) - time.monotonic())
+        # nothing to remove when the post expires
+        await delete(chat_id, message_id)
 
 
 async def start(update: Update, context: CallbackContext):
@@ -180,6 +294,27 @@ async def on_error(update, context: CallbackContext):
     )
 
 
+@lru_cache(1024)
+def render(post: Post) -> tuple[str, bool]:
+    """ The message text and whether to disable the link preview. Computed once for all the chats """
+    description = post.description
+    if len(description) > 3800:
+        description = description[:3800] + '...'
+    text = f'{post.title}\n{description}\n{post.url}'.strip()
+    if '<' in text:
+        text = quote_plus(text)
+    return text, bool(post.title or description)
+
+
+def render_digest(posts: Sequence[Post]) -> str:
+    text = '\n\n'.join(
+        f'{i}. {post.title or post.description[:100]}\n{post.url}'.strip() for i, post in enumerate(posts, 1)
+    )
+    if len(text) > 4096:
+        text = text[:4093] + '...'
+    return text
+
+
 def make_keyboard(channels):
     buttons = [InlineKeyboardButton(c.name, callback_data=f'DELETE:{c.pk}') for c in channels]
     if not buttons:
@@ -1,129 +1,411 @@
 import asyncio
+import heapq
+import itertools
 import logging
+import struct
+import time
 from asyncio import Queue
-from collections import defaultdict
+from collections import deque
+from contextlib import aclosing, suppress
+from datetime import datetime, timedelta
 from logging.handlers import TimedRotatingFileHandler
+from pathlib import Path
 
 from aiohttp import ClientSession
 from sqlalchemy_utils import create_database, database_exists
 
 from .base import make_engine
-from .crud import delete, get_old_posts, list_all_sources, list_sources_and_posts, save_chat_post, save_post
-from .destinations import Destination
-from .models import Base, Post
+from .crud import (
+    ack_outbox, claim_outbox, expire_posts, get_post_rates, list_all_sources, list_deadlines, list_sources_and_posts,
+    reset_outbox, retry_outbox, save_chat_post, save_posts, update_validators
+)
+from .destinations import Destination, Throttled
+from .metrics import (
+    DELIVERY_SECONDS, FETCH_ERRORS, FETCH_SECONDS, POSTS_DISCOVERED, QUEUE_HIGH_WATER, QUEUE_SIZE, SEND_ERRORS,
+    SEND_SECONDS, serve
+)
+from .migrations import migrate
+from .models import Identifier, Notify, Remove, Source
+from .scheduler import ExpiryScheduler, PollScheduler
 from .settings import config
 from .sources import ChannelAdapter
+from .utils import HostLimiter, TokenBucket, TrackedQueue, acquire_tokens
+from .visited import VisitedIds, VisitedIndex
 
 
 logger = logging.getLogger(__name__)
 
 
 async def start(destinations: list[Destination]):
-    queue, queues, tasks = Queue(), {}, []
+    queue, queues, pending, tasks = TrackedQueue('router', config.router_queue_size), {}, {}, []
+    expiry = ExpiryScheduler(list_deadlines, config.expiry_page_size)
     for dst in destinations:
-        q = queues[dst.name()] = Queue()
-        tasks.append(run_destination(dst, q))
-
+        name = dst.name()
+        q = queues[name] = TrackedQueue(name, config.destination_queue_size)
+        pending[name] = asyncio.Event()
+        tasks.extend([run_outbox(name, q, pending[name]), run_destination(dst, q, expiry)])
+
+    if config.metrics_port is not None:
+        for q in [queue, *queues.values()]:
+            QUEUE_SIZE.track(q.qsize, q.name)
+            QUEUE_HIGH_WATER.track(lambda q=q: q.high_water, q.name)
+        tasks.append(serve(config.metrics_port))
+
+    await reset_outbox()
     await asyncio.gather(
         run_source(queue),
-        run_router(queue, queues),
-        delete_old_posts(queues),
+        run_router(queue, pending),
+        delete_old_posts(queues, expiry),
+        report_queues([queue, *queues.values()]),
         *tasks,
     )
 
 
-async def run_source(queue: Queue):
-    # todo: will this consume all ram?
-    visited = defaultdict(set)
-    visited.update(list_sources_and_posts())
+async def run_source(queue: TrackedQueue):
+    visited = await load_visited()
+    limiter = HostLimiter(config.poll_concurrency, config.poll_host_concurrency)
+    scheduler = PollScheduler(
+        config.poll_min_interval, config.poll_max_interval, config.poll_rate_factor, config.poll_jitter
+    )
+    adapters, tasks = {}, set()
 
-    async with ClientSession() as session:
+    async def refresh():
+        rates, updated = {}, None
         while True:
-            groups = defaultdict(list)
-            for notify, source in list_all_sources():
-                groups[source.type].append((notify, source))
-
-            for kind, sources in groups.items():
-                adapter = ChannelAdapter.dispatch_type(kind)()
-
-                for notify, source in sources:
-                    try:
-                        async for update in adapter.update(source.update_url, source.name, session):
-                            if update.id in visited[source.pk]:
-                                logger.debug('Post exists: %s for %s (%s)', update.id, source.name, source.type)
-                                continue
-
-                            logger.info('New post: %s for %s (%s)', update.id, source.name, source.type)
-                            visited[source.pk].add(update.id)
-
-                            if update.content is None:
-                                update.content = await adapter.scrape(update.url, session)
-
-                            await queue.put((source, update, notify))
+            # the rates over the whole history barely move, and computing them occupies the database thread
+            if updated is None or time.monotonic() - updated >= 60 * 60:
+                rates = await get_post_rates(timedelta(seconds=config.poll_history))
+                updated = time.monotonic()
+
+            scheduler.update(await list_all_sources(), rates)
+            await asyncio.sleep(60)
+
+    async def poll(notify: bool, source: Source):
+        success = False
+        try:
+            if source.type not in adapters:
+                adapters[source.type] = ChannelAdapter.dispatch_type(source.type)()
+
+            success = await poll_source(
+                adapters[source.type], source, notify, visited[source.pk], session, limiter, queue
+            )
+        except Exception:
+            logger.exception('Could not poll %s (%s)', source.name, source.type)
+            FETCH_ERRORS.inc(source.type)
+        finally:
+            # the source must be polled again in any case
+            scheduler.done(source.pk, success)
+
+    async def dispatch():
+        while True:
+            # backpressure: a full queue means the router is behind, so don't start new polls for a while
+            await queue.drained()
+            task = asyncio.create_task(poll(*await scheduler.next()))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
 
-                    except Exception as e:
-                        logger.error(
-                            'An exception while processing %s (%s): %s: %s',
-                            source.name, source.type, type(e).__name__, e,
-                        )
+    async def persist():
+        while True:
+            await asyncio.sleep(600)
+            # only the copy is made here, the writing and fsync don't block the loop
+            await asyncio.to_thread(VisitedIndex.dump, _visited_path(), visited.snapshot())
+            _log_visited(visited)
+
+    try:
+        async with ClientSession() as session:
+            await asyncio.gather(refresh(), dispatch(), persist())
+    finally:
+        save_visited(visited)
+
+
+async def poll_source(adapter: ChannelAdapter, source: Source, notify: bool, visited: VisitedIds,
+                      session: ClientSession, limiter: HostLimiter, queue: Queue) -> bool:
+    # the validators are saved only if the update was successful
+    validators = source.validators.copy()
+    async with limiter(source.update_url):
+        start = time.perf_counter()
+        try:
+            updates = {}
+            async with aclosing(adapter.update(
+                    source.update_url, source.name, session, validators, visited.__contains__
+            )) as stream:
+                async for update in stream:
+                    if update.id in visited:
+                        logger.debug('Post exists: %s for %s (%s)', update.id, source.name, source.type)
+                        continue
+
+                    updates.setdefault(update.id, update)
+
+            updates = list(updates.values())
+            # deliver the posts starting from the oldest one
+            if adapter.newest_first:
+                updates.reverse()
+
+            FETCH_SECONDS.observe(time.perf_counter() - start, source.type)
+            for update in updates:
+                logger.info('New post: %s for %s (%s)', update.id, source.name, source.type)
+                POSTS_DISCOVERED.inc(source.type)
+                visited.add(update.id)
+
+                if update.content is None:
+                    update.content = await adapter.scrape(update.url, session)
+
+                await queue.put((source, update, notify))
+
+            if validators != source.validators:
+                await update_validators(source.pk, validators)
+                source.validators = validators
+
+            return True
+
+        except Exception as e:
+            logger.error(
+                'An exception while processing %s (%s): %s: %s',
+                source.name, source.type, type(e).__name__, e,
+            )
+            FETCH_ERRORS.inc(source.type)
+            return False
+
+
+async def load_visited() -> VisitedIndex:
+    path = _visited_path()
+    if path.exists():
+        try:
+            return VisitedIndex.load(path, config.visited_size)
+        except (ValueError, struct.error) as e:
+            logger.warning('Could not load the visited index: %s', e)
+
+    visited = VisitedIndex(config.visited_size)
+    visited.update(await list_sources_and_posts(config.visited_size))
+    return visited
+
+
+def save_visited(visited: VisitedIndex):
+    visited.save(_visited_path())
+    _log_visited(visited)
+
+
+def _log_visited(visited: VisitedIndex):
+    memory = visited.memory()
+    logger.info('Visited index: %d sources, %.2f MiB', len(memory), sum(memory.values()) / 2 ** 20)
+    for pk, size in sorted(memory.items(), key=lambda x: x[1], reverse=True):
+        logger.debug('Visited index: source %d uses %d bytes', pk, size)
+
+
+def _visited_path() -> Path:
+    return config.visited_path or config.db_path.with_suffix('.visited')
+
+
+async def delete_old_posts(queues: dict[str, Queue], expiry: ExpiryScheduler):
+    # spread the removals, e.g. after a downtime
+    limiter = TokenBucket(config.expiry_rate)
+    while True:
+        for chat_type, chat_id, message_id in await expire_posts(await expiry.next()):
+            if chat_type in queues:
+                await acquire_tokens(limiter)
+                await queues[chat_type].put(Remove(chat_id, message_id))
 
-                # release the allocated resources
-                del adapter
 
-            await asyncio.sleep(600)
+async def report_queues(queues: list[TrackedQueue]):
+    while True:
+        await asyncio.sleep(600)
+        for queue in queues:
+            logger.info(
+                'Queue %s: %d items, bound %d, high-water mark %d', queue.name, queue.qsize(), queue.maxsize,
+                queue.high_water,
+            )
 
 
-async def delete_old_posts(queues: dict[str, Queue]):
+async def run_router(updates: Queue, pending: dict[str, asyncio.Event]):
     while True:
-        for chat_type, chat_id, message_id in get_old_posts():
-            await queues[chat_type].put(('remove', chat_id, message_id))
+        # take all the available updates, but don't wait for more
+        batch = [await updates.get()]
+        while len(batch) < config.router_batch_size and not updates.empty():
+            batch.append(updates.get_nowait())
+        logger.debug('Got %d updates', len(batch))
+
+        for destination in await save_posts(batch):
+            # the other destinations will pick up their entries after a restart
+            if destination in pending:
+                pending[destination].set()
 
-        await asyncio.sleep(3600)
+        for _ in batch:
+            updates.task_done()
 
 
-async def run_router(updates: Queue, queues: dict[str, Queue]):
+async def run_outbox(destination: str, queue: Queue, pending: asyncio.Event):
+    """ Move the outbox entries to the destination queue, one batch at a time """
     while True:
-        source, update, notify = await updates.get()
-        logger.debug('Got update %s for source %s (%s)', update.id, source.name, source.type)
+        pending.clear()
+        batch = await claim_outbox(destination, config.outbox_batch_size)
+        # the bounded queue holds back the next batch
+        for chat_id, chat_pk, post_pk, digest, created, post in batch:
+            await queue.put(Notify(chat_id, chat_pk, post_pk, post, digest, created))
 
-        # TODO: without persistence some message might get lost
-        for chat_id, chat_type, chat_pk, post_pk, post in save_post(source, update, notify):
-            await queues[chat_type].put(('notify', chat_id, chat_pk, post_pk, post.json()))
+        if not batch:
+            # the failed deliveries are due later
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(pending.wait(), config.outbox_retry_delay)
 
-        updates.task_done()
 
+async def run_destination(destination: Destination, queue: Queue, expiry: ExpiryScheduler):
+    name = destination.name()
+    # messages for the same chat always go to the same worker, so they are processed in order
+    shards = [Queue(config.destination_queue_size) for _ in range(config.destination_workers)]
 
-async def run_destination(destination: Destination, queue: Queue):
-    async with destination:
+    async def dispatch():
         while True:
             message = await queue.get()
-            try:
-                cmd, chat_id, *args = message
-
-                if cmd == 'notify':
-                    chat_pk, post_pk, post = args
-                    post = Post.parse_raw(post)
+            await shards[hash(message.chat_id) % len(shards)].put(message)
+
+    async def deliver(messages: list[Notify]):
+        chat_id, posts = messages[0].chat_id, [message.post for message in messages]
+        logger.info('Notifying %s about %s', chat_id, ', '.join(post.title or post.description[:20] for post in posts))
+        start = time.perf_counter()
+        try:
+            if len(posts) == 1:
+                message_ids = [await destination.notify(chat_id, posts[0])]
+            else:
+                message_ids = await destination.notify_digest(chat_id, posts)
+
+        except Throttled:
+            raise
+
+        except Exception as e:
+            logger.exception('Error while sending %s', messages)
+            SEND_ERRORS.inc(name)
+            if destination.transient(e):
+                for message in messages:
+                    if not await retry_outbox(
+                            message.chat_pk, message.post_pk, config.outbox_retry_delay, config.outbox_max_attempts
+                    ):
+                        logger.warning('Giving up on sending %s to %s', message.post_pk, chat_id)
+                return
+
+            # permanent errors are not retried
+            message_ids = [None] * len(messages)
+
+        else:
+            SEND_SECONDS.observe(time.perf_counter() - start, name)
+            now = datetime.utcnow()
+            for message in messages:
+                if message.created is not None:
+                    DELIVERY_SECONDS.observe((now - message.created).total_seconds(), name)
+
+        for message, message_id in zip(messages, message_ids, strict=True):
+            if message_id is None:
+                await ack_outbox(message.chat_pk, message.post_pk)
+            else:
+                # also acks the outbox entry
+                expiry.add(*await save_chat_post(message.chat_pk, message.post_pk, message_id))
+
+    async def remove(message: Remove):
+        logger.info('Removing old post %s from %s', message.message_id, message.chat_id)
+        # the chat posts are already marked as deleted by `expire_posts`
+        await destination.remove(message.chat_id, message.message_id)
+
+    async def work(shard: Queue):
+        """ Sends to the chats that are ready, the throttled chats don't hold back the others """
+        # chat id -> the messages waiting for the chat to be ready, in order
+        waiting: dict[Identifier, deque[Notify | Remove | list[Notify]]] = {}
+        # (time, order, chat id) - when each chat with waiting messages is ready
+        ready, order = [], itertools.count()
+        # chat id -> (due time, notifications) for the chats that receive digests
+        digests: dict[Identifier, tuple[float, list[Notify]]] = {}
+        # the messages taken from the shard, but not processed yet
+        taken = 0
+
+        def schedule(chat_id: Identifier):
+            heapq.heappush(ready, (destination.ready_at(chat_id), next(order), chat_id))
+
+        def enqueue(chat_id: Identifier, item):
+            if chat_id not in waiting:
+                waiting[chat_id] = deque()
+                schedule(chat_id)
+            waiting[chat_id].append(item)
+
+        def release(chat_id: Identifier):
+            if waiting[chat_id]:
+                schedule(chat_id)
+            else:
+                del waiting[chat_id]
+
+        def done():
+            nonlocal taken
+            taken -= 1
+            queue.task_done()
 
-                    logger.info('Notifying %s about %s', chat_id, post.title or post.description[:20])
-                    message_id = await destination.notify(chat_id, post)
-                    if message_id is not None:
-                        save_chat_post(chat_pk, post_pk, message_id)
+        while True:
+            now = time.monotonic()
+            # the due digests are sent in order with the other messages of the chat
+            for chat_id, (due, messages) in list(digests.items()):
+                if due <= now:
+                    del digests[chat_id]
+                    enqueue(chat_id, messages)
+
+            wake = min((due for due, _ in digests.values()), default=float('inf'))
+            if ready:
+                wake = min(wake, ready[0][0])
+            if wake > now:
+                timeout = None if wake == float('inf') else wake - now
+                if taken >= shard.maxsize > 0:
+                    # too many throttled messages, let the backpressure work
+                    await asyncio.sleep(timeout)
+                    continue
+
+                try:
+                    message = await asyncio.wait_for(shard.get(), timeout)
+                except asyncio.TimeoutError:
+                    continue
+
+                taken += 1
+                enqueue(message.chat_id, message)
+                continue
+
+            _, _, chat_id = heapq.heappop(ready)
+            if destination.ready_at(chat_id) > time.monotonic():
+                # e.g. the chat was paused after a flood error
+                schedule(chat_id)
+                continue
+
+            item = waiting[chat_id].popleft()
+            if isinstance(item, Notify) and item.digest:
+                _, messages = digests.setdefault(chat_id, (now + item.digest, []))
+                messages.append(item)
+                done()
+                if len(messages) < config.digest_max_items:
+                    release(chat_id)
+                    continue
+
+                del digests[chat_id]
+                item = messages
 
-                elif cmd == 'remove':
-                    message_id, = args
+            try:
+                if isinstance(item, list):
+                    await deliver(item)
+                elif isinstance(item, Notify):
+                    await deliver([item])
+                elif isinstance(item, Remove):
+                    await remove(item)
+                else:
+                    raise TypeError(item)
 
-                    logger.info('Removing old post %s from %s', message_id, chat_id)
-                    await destination.remove(chat_id, message_id)
-                    delete(message_id)
+            except Throttled:
+                # try again once the chat is ready
+                waiting[chat_id].appendleft(item)
+                release(chat_id)
+                continue
 
-                else:
-                    raise TypeError(cmd)
+            except Exception:
+                # a single failed message must not stop the destination
+                logger.exception('Error while processing message %s', item)
 
-            except BaseException:
-                logger.exception('Error while processing message %s', message)
-                raise
+            release(chat_id)
+            if not isinstance(item, list):
+                done()
 
-            queue.task_done()
+    async with destination:
+        await asyncio.gather(dispatch(), *map(work, shards))
 
 
 def init():
@@ -136,8 +418,8 @@ def init():
     engine = make_engine()
     if not database_exists(engine.url):
         create_database(engine.url)
-        Base.metadata.create_all(engine)
 
+    migrate(engine)
     assert database_exists(engine.url)
 
     # logging
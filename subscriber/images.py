@@ -0,0 +1,71 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+import aiohttp
+
+from .base import db, get_or_create, in_db_thread
+from .models import FileTable, FileUrlTable, Validators
+from .settings import config
+from .utils import conditional_get, store_stream
+
+
+logger = logging.getLogger(__name__)
+# concurrent requests for the same url share a single download
+_downloads: dict[str, asyncio.Task] = {}
+
+
+async def url_to_digest(url: str | None, session: aiohttp.ClientSession) -> str | None:
+    """ Download an image into the storage and return its digest. Known urls are not downloaded again """
+    if url is None:
+        return
+
+    task = _downloads.get(url)
+    if task is None:
+        task = _downloads[url] = asyncio.create_task(_download(url, session))
+        task.add_done_callback(lambda _: _downloads.pop(url, None))
+
+    # a cancelled caller must not cancel the download for the others
+    return await asyncio.shield(task)
+
+
+async def _download(url: str, session: aiohttp.ClientSession) -> str | None:
+    digest, validators, checked = await _lookup(url)
+    if digest is not None and (
+            config.image_revalidate_after is None
+            or datetime.utcnow() - checked < timedelta(seconds=config.image_revalidate_after)
+    ):
+        return digest
+
+    async with conditional_get(url, session, validators) as response:
+        if response is None:
+            await _remember(url, digest, validators)
+            return digest
+
+        if not response.ok:
+            logger.warning('Could not download the image %s: %s', url, response.status)
+            return digest
+
+        digest = await store_stream(response.content.iter_chunked(64 * 1024))
+
+    await _remember(url, digest, validators)
+    return digest
+
+
+@in_db_thread
+def _lookup(url: str) -> tuple[str | None, Validators, datetime | None]:
+    with db() as session:
+        entry = session.query(FileUrlTable).where(FileUrlTable.url == url).first()
+        if entry is None:
+            return None, Validators(), None
+        return entry.file.internal, Validators(etag=entry.etag, last_modified=entry.last_modified), entry.checked
+
+
+@in_db_thread
+def _remember(url: str, digest: str, validators: Validators):
+    with db() as session:
+        file, _ = get_or_create(session, FileTable, internal=digest)
+        entry, _ = get_or_create(session, FileUrlTable, defaults={'file_id': file.id}, url=url)
+        entry.file_id = file.id
+        entry.etag, entry.last_modified = validators.etag, validators.last_modified
+        entry.checked = datetime.utcnow()
@@ -0,0 +1,137 @@
+"""
+Runtime metrics in the Prometheus text format, served over http when `metrics_port` is set.
+"""
+import asyncio
+import logging
+from bisect import bisect_left
+from typing import Callable
+
+from aiohttp import web
+
+
+logger = logging.getLogger(__name__)
+REGISTRY: list['Metric'] = []
+# seconds
+DEFAULT_BUCKETS = 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60
+
+
+class Metric:
+    kind: str
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        self.name, self.description, self.labels = name, description, labels
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels: tuple[str, ...]) -> tuple[str, ...]:
+        assert len(labels) == len(self.labels), (self.name, labels)
+        return tuple(map(str, labels))
+
+    def _format(self, key: tuple[str, ...], **extra) -> str:
+        pairs = [*zip(self.labels, key), *extra.items()]
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{label}="{_escape(value)}"' for label, value in pairs) + '}'
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name + self._format(key), value
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(f'{name} {value}' for name, value in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels: str, value: float = 1):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, *labels: str):
+        self._values[self._key(labels)] = value
+
+    def track(self, func: Callable[[], float], *labels: str):
+        """ The value is computed at each scrape """
+        self._values[self._key(labels)] = func
+
+    def samples(self):
+        for name, value in super().samples():
+            yield name, value() if callable(value) else value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels: str):
+        key = self._key(labels)
+        if key not in self._values:
+            # a count for each bucket and +Inf, the sum
+            self._values[key] = [0] * (len(self.buckets) + 1), [0.]
+        counts, total = self._values[key]
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def samples(self):
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip([*map(str, self.buckets), '+Inf'], counts):
+                cumulative += count
+                yield f'{self.name}_bucket{self._format(key, le=bound)}', cumulative
+            yield f'{self.name}_sum{self._format(key)}', total[0]
+            yield f'{self.name}_count{self._format(key)}', cumulative
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def render() -> str:
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+async def serve(port: int):
+    async def handle(request):
+        return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, port=port).start()
+        logger.info('Serving metrics on port %d', port)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+# polling
+FETCH_SECONDS = Histogram('subscriber_fetch_seconds', 'Time to poll a source', ('type',))
+FETCH_ERRORS = Counter('subscriber_fetch_errors_total', 'Failed polls', ('type',))
+POSTS_DISCOVERED = Counter('subscriber_posts_discovered_total', 'New posts found while polling', ('type',))
+# queues
+QUEUE_SIZE = Gauge('subscriber_queue_size', 'Items in the queue', ('queue',))
+QUEUE_HIGH_WATER = Gauge('subscriber_queue_high_water', 'The largest number of items seen in the queue', ('queue',))
+# database
+DB_SECONDS = Histogram(
+    'subscriber_db_seconds', 'Duration of database calls, including the wait for the database thread', ('function',)
+)
+# delivery
+SEND_SECONDS = Histogram('subscriber_send_seconds', 'Time to send a message or a digest', ('destination',))
+SEND_ERRORS = Counter('subscriber_send_errors_total', 'Failed deliveries', ('destination',))
+TELEGRAM_RETRIES = Counter('subscriber_telegram_retries_total', 'Requests that hit the flood limits', ('limit',))
+DELIVERY_SECONDS = Histogram(
+    'subscriber_delivery_seconds', 'Time from discovering a post to delivering it', ('destination',),
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 6 * 3600, 24 * 3600),
+)
@@ -0,0 +1,84 @@
+"""
+Versioned schema changes. The current version is stored in `PRAGMA user_version`.
+
+A new database is created right away from the models at the latest version, the existing ones apply
+the missing migrations in order. Migrations must tolerate the changes that were already made by hand,
+hence `IF NOT EXISTS` and friends.
+"""
+import logging
+
+from sqlalchemy import Connection, Engine, inspect, text
+
+from .models import Base
+
+
+logger = logging.getLogger(__name__)
+
+
+def _unversioned(connection: Connection):
+    """ The tables and nullable columns added before the versioning """
+    Base.metadata.create_all(connection)
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                assert column.nullable or column.server_default is not None, column
+                ddl = f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column.type.compile(connection.dialect)}'
+                if not column.nullable:
+                    ddl += f' NOT NULL DEFAULT {column.server_default.arg}'
+                connection.execute(text(ddl))
+
+
+def _hot_path_indexes(connection: Connection):
+    """ Indexes for keep/delete, the upcoming deadlines and the latest posts of each source """
+    connection.execute(text('CREATE INDEX IF NOT EXISTS "ix_ChatPost_message_id" ON "ChatPost" (message_id)'))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS "ix_ChatPost_state_deadline" ON "ChatPost" (state, deadline)'
+    ))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS "ix_Post_source_id_id" ON "Post" (source_id, id DESC)'))
+    connection.execute(text('ANALYZE'))
+
+
+def _outbox_retries(connection: Connection):
+    """ Retries of the failed deliveries """
+    existing = {column['name'] for column in inspect(connection).get_columns('Outbox')}
+    if 'attempts' not in existing:
+        connection.execute(text('ALTER TABLE "Outbox" ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0'))
+    if 'retry_at' not in existing:
+        connection.execute(text('ALTER TABLE "Outbox" ADD COLUMN retry_at DATETIME'))
+
+
+def _post_rates_index(connection: Connection):
+    """ An index for the post rates of each source """
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS "ix_Post_source_id_created" ON "Post" (source_id, created)'
+    ))
+    connection.execute(text('ANALYZE'))
+
+
+MIGRATIONS = [
+    _unversioned,
+    _hot_path_indexes,
+    _outbox_retries,
+    _post_rates_index,
+]
+
+
+def get_version(connection: Connection) -> int:
+    return connection.execute(text('PRAGMA user_version')).scalar()
+
+
+def migrate(engine: Engine):
+    with engine.begin() as connection:
+        version = get_version(connection)
+        if version == 0 and not inspect(connection).get_table_names():
+            logger.info('Creating the database schema')
+            Base.metadata.create_all(connection)
+            version = len(MIGRATIONS)
+            connection.execute(text(f'PRAGMA user_version = {version:d}'))
+
+        for version, migration in enumerate(MIGRATIONS[version:], version + 1):
+            logger.info('Migrating the database to version %d: %s', version, migration.__doc__)
+            migration(connection)
+            connection.execute(text(f'PRAGMA user_version = {version:d}'))
@@ -1,7 +1,9 @@
 import enum
+from dataclasses import dataclass
+from datetime import datetime
 
-from pydantic import BaseModel
-from sqlalchemy import Column, DateTime, Enum, ForeignKey, Integer, Unicode, UniqueConstraint, func
+from pydantic import BaseModel, Field
+from sqlalchemy import Column, DateTime, Enum, ForeignKey, Index, Integer, Unicode, UniqueConstraint, func
 from sqlalchemy.orm import relationship
 
 from .base import Base
@@ -20,7 +22,20 @@ class FileTable(Base):
     telegram = Column(Unicode, nullable=True, unique=True)
 
 
-class File(BaseModel, extra='forbid'):
+class FileUrlTable(Base):
+    __tablename__ = 'FileUrl'
+    id = Column(Integer, primary_key=True)
+    checked = Column(DateTime, nullable=False, server_default=func.now())
+
+    url = Column(Unicode, nullable=False, unique=True)
+    file_id = Column(ForeignKey(FileTable.id, ondelete='CASCADE'), nullable=False)
+    file = relationship(FileTable)
+    # http validators of the last response
+    etag = Column(Unicode, nullable=True)
+    last_modified = Column(Unicode, nullable=True)
+
+
+class File(BaseModel, extra='forbid', frozen=True):
     internal: Identifier
     telegram: Identifier | None
 
@@ -34,6 +49,9 @@ class SourceTable(Base):
     name = Column(Unicode(1000), nullable=False)
     image_id = Column(ForeignKey(FileTable.id), nullable=True)
     image = relationship(FileTable)
+    # http validators of the last response from `update_url`
+    etag = Column(Unicode, nullable=True)
+    last_modified = Column(Unicode, nullable=True)
 
     chats = relationship('ChatTable', secondary='ChatToSource', back_populates='sources')
     posts = relationship('PostTable', back_populates='source')
@@ -45,11 +63,17 @@ class SourceTable(Base):
         return f'{self.name} - {self.type}'
 
 
+class Validators(BaseModel):
+    etag: str | None = None
+    last_modified: str | None = None
+
+
 class Source(BaseModel):
     pk: int
     name: str
     type: str
     update_url: str
+    validators: Validators = Field(default_factory=Validators)
 
 
 class ChatTable(Base):
@@ -59,6 +83,8 @@ class ChatTable(Base):
     identifier = Column(Unicode, nullable=False, unique=True)
     type = Column(Unicode, nullable=False)
     ttl = Column(Integer, nullable=True)
+    # posts are grouped into digests over this many seconds. None - each post is sent right away
+    digest = Column(Integer, nullable=True)
 
     sources = relationship('SourceTable', secondary='ChatToSource', back_populates='chats')
     chat_posts = relationship('ChatPost', back_populates='chat')
@@ -86,13 +112,40 @@ class PostTable(Base):
     chat_posts = relationship('ChatPost', back_populates='post')
 
 
-class Post(BaseModel):
+# the latest posts of each source
+Index('ix_Post_source_id_id', PostTable.source_id, PostTable.id.desc())
+# the recent posts of each source
+Index('ix_Post_source_id_created', PostTable.source_id, PostTable.created)
+
+
+class Post(BaseModel, frozen=True):
+    """ A post is shared between all the chats it is sent to """
     title: str
     description: str
     url: str
     image: File | None
 
 
+# messages for the destinations
+
+@dataclass(frozen=True, slots=True)
+class Notify:
+    chat_id: Identifier
+    chat_pk: int
+    post_pk: int
+    post: Post
+    # the chat's digest window
+    digest: int | None = None
+    # when the post was discovered
+    created: datetime | None = None
+
+
+@dataclass(frozen=True, slots=True)
+class Remove:
+    chat_id: Identifier
+    message_id: Identifier
+
+
 # secondary
 
 class ChatToSource(Base):
@@ -112,7 +165,13 @@ class ChatPostState(enum.Enum):
 
 class ChatPost(Base):
     __tablename__ = 'ChatPost'
-    __table_args__ = UniqueConstraint('chat_id', 'post_id'),
+    __table_args__ = (
+        UniqueConstraint('chat_id', 'post_id'),
+        # keep, delete
+        Index('ix_ChatPost_message_id', 'message_id'),
+        # the upcoming deadlines
+        Index('ix_ChatPost_state_deadline', 'state', 'deadline'),
+    )
     id = Column(Integer, primary_key=True)
 
     state = Column(Enum(ChatPostState), nullable=False)
@@ -124,3 +183,21 @@ class ChatPost(Base):
     chat = relationship(ChatTable, back_populates='chat_posts')
     post_id = Column(ForeignKey(PostTable.id, ondelete='CASCADE'), nullable=False)
     post = relationship(PostTable, back_populates='chat_posts')
+
+
+class Outbox(Base):
+    """ Chat posts that are waiting to be sent """
+    __tablename__ = 'Outbox'
+    __table_args__ = UniqueConstraint('chat_id', 'post_id'), Index('ix_Outbox_destination', 'destination', 'claimed')
+    id = Column(Integer, primary_key=True)
+
+    # same as the chat type
+    destination = Column(Unicode, nullable=False)
+    # the entry is being sent right now
+    claimed = Column(DateTime, nullable=True)
+    # failed deliveries are retried after a backoff
+    attempts = Column(Integer, nullable=False, server_default='0')
+    retry_at = Column(DateTime, nullable=True)
+
+    chat_id = Column(ForeignKey(ChatTable.id, ondelete='CASCADE'), nullable=False)
+    post_id = Column(ForeignKey(PostTable.id, ondelete='CASCADE'), nullable=False)
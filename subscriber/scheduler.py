@@ -0,0 +1,153 @@
+import asyncio
+import heapq
+import random
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, Sequence
+
+from .models import Source
+
+
+class PollScheduler:
+    """
+    Decides when each source should be polled next.
+
+    The poll interval is inversely proportional to the observed post rate of a source,
+    bounded by `min_interval` and `max_interval`. Failed polls are retried with an exponential backoff.
+    """
+
+    def __init__(self, min_interval: float, max_interval: float, factor: float, jitter: float):
+        self.min_interval, self.max_interval = min_interval, max_interval
+        self.factor, self.jitter = factor, jitter
+        # (due, pk) pairs, entries that don't match `_due` are outdated
+        self._heap = []
+        self._due: dict[int, float] = {}
+        self._sources: dict[int, tuple[bool, Source]] = {}
+        self._rates: dict[int, float] = {}
+        self._errors: dict[int, int] = {}
+        self._initialized = False
+        self._changed = asyncio.Event()
+
+    def interval(self, pk: int) -> float:
+        rate = self._rates.get(pk, 0)
+        interval = 1 / (rate * self.factor) if rate > 0 else self.max_interval
+        interval *= 2 ** min(self._errors.get(pk, 0), 16)
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def update(self, sources: Sequence[tuple[bool, Source]], rates: dict[int, float]):
+        """ Sync with the current list of sources and their post rates (posts per second) """
+        now = time.monotonic()
+        self._rates = rates
+        current = {source.pk: (notify, source) for notify, source in sources}
+        for pk in set(self._sources) - set(current):
+            self._due.pop(pk, None)
+            self._errors.pop(pk, None)
+
+        for pk in set(current) - set(self._sources):
+            if self._initialized:
+                # a new subscription
+                delay = 0
+            else:
+                # spread the sources, so they don't fire all at once after a restart
+                delay = random.uniform(0, self.interval(pk))
+            self._push(pk, now + delay)
+
+        self._sources = current
+        self._initialized = True
+        self._changed.set()
+
+    async def next(self) -> tuple[bool, Source]:
+        """ Wait for the next due source. It won't be scheduled again until `done` is called """
+        while True:
+            while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+
+            timeout = None
+            if self._heap:
+                timeout = self._heap[0][0] - time.monotonic()
+                if timeout <= 0:
+                    _, pk = heapq.heappop(self._heap)
+                    del self._due[pk]
+                    return self._sources[pk]
+
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def done(self, pk: int, success: bool):
+        if success:
+            self._errors.pop(pk, None)
+        else:
+            self._errors[pk] = self._errors.get(pk, 0) + 1
+
+        if pk in self._sources:
+            self._push(pk, time.monotonic() + self.interval(pk))
+
+    def _push(self, pk: int, due: float):
+        self._due[pk] = due
+        heapq.heappush(self._heap, (due, pk))
+        self._changed.set()
+
+
+class ExpiryScheduler:
+    """
+    Yields the chat posts as their deadlines pass.
+
+    Only the `page` earliest deadlines are kept in a heap, the next page is loaded with `load(after, limit)`
+    once the heap is empty. The entries are not validated here: kept or deleted posts must be filtered out later.
+    """
+
+    def __init__(self, load: Callable[[tuple[datetime, int] | None, int], Awaitable[list[tuple[datetime, int]]]],
+                 page: int):
+        self.page = page
+        self._load = load
+        self._heap: list[tuple[datetime, int]] = []
+        # the last loaded (deadline, pk). The later entries are loaded with the next pages
+        self._cursor = None
+        self._complete = False
+        self._changed = asyncio.Event()
+
+    def add(self, deadline: datetime, pk: int):
+        entry = deadline, pk
+        if self._cursor is not None and entry <= self._cursor:
+            heapq.heappush(self._heap, entry)
+            self._changed.set()
+        elif self._complete and len(self._heap) < self.page:
+            # all the entries up to this one are in memory
+            heapq.heappush(self._heap, entry)
+            self._cursor = entry
+            self._changed.set()
+        else:
+            # will be loaded with the next pages
+            self._complete = False
+
+    async def next(self) -> list[int]:
+        """ Wait for the next due entries, at most `page` at a time """
+        while True:
+            if not self._heap and not self._complete:
+                entries = await self._load(self._cursor, self.page)
+                for entry in entries:
+                    heapq.heappush(self._heap, entry)
+                if entries:
+                    self._cursor = entries[-1]
+                self._complete = len(entries) < self.page
+                continue
+
+            timeout = None
+            if self._heap:
+                now = datetime.utcnow()
+                timeout = (self._heap[0][0] - now).total_seconds()
+                if timeout <= 0:
+                    due = []
+                    while self._heap and self._heap[0][0] <= now and len(due) < self.page:
+                        due.append(heapq.heappop(self._heap)[1])
+                    return due
+
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -11,6 +11,65 @@ class Settings(BaseSettings, extra='ignore'):
     storage_path: Path
     logs_path: Path | None = None
     db_path: Path = ROOT / 'db.sqlite3'
+    # sqlite tuning
+    db_journal_mode: str = 'wal'
+    db_synchronous: str = 'normal'
+    # negative values are in KiB
+    db_cache_size: int = -64 * 1024
+    db_mmap_size: int = 256 * 1024 * 1024
+    # milliseconds to wait for a lock before failing
+    db_busy_timeout: int = 5000
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    # the number of threads that run the database queries
+    db_threads: int = 1
+    # polling
+    poll_concurrency: int = 32
+    poll_host_concurrency: int = 4
+    # the poll interval is adjusted to the post rate: about `poll_rate_factor` polls between two posts
+    poll_min_interval: int = 120
+    poll_max_interval: int = 3 * 60 * 60
+    poll_rate_factor: float = 20
+    poll_jitter: float = 0.1
+    # the period used to estimate the post rate
+    poll_history: int = 30 * 24 * 60 * 60
+    # known images are revalidated with a conditional request after this many seconds. None - never
+    image_revalidate_after: int | None = 30 * 24 * 60 * 60
+    # images are downscaled to fit into a square with this side and re-encoded. None - store the originals
+    image_max_size: int | None = None
+    # any format supported by Pillow, e.g. jpeg or webp
+    image_format: str = 'jpeg'
+    image_quality: int = 85
+    # the number of processes used to parse feeds and pages. 0 - parse in the main thread
+    parse_workers: int = 2
+    # the number of the most recent post ids per source kept in memory
+    visited_size: int = 1000
+    # where the visited ids are saved for fast restarts. Defaults to a file next to the database
+    visited_path: Path | None = None
+    # queue bounds, 0 - unbounded. Pollers and the router wait when the next queue is full
+    router_queue_size: int = 1000
+    destination_queue_size: int = 1000
+    # the max number of updates saved in a single transaction
+    router_batch_size: int = 100
+    # the number of outbox entries claimed by a destination at once
+    outbox_batch_size: int = 100
+    # deliveries that failed with a transient error are retried after this many seconds, doubled with each attempt
+    outbox_retry_delay: float = 60
+    outbox_max_attempts: int = 5
+    # the number of upcoming post deadlines kept in memory
+    expiry_page_size: int = 1000
+    # old posts removed per second
+    expiry_rate: float = 10
+    # the max number of posts in a digest
+    digest_max_items: int = 10
+    # the number of concurrent deliveries per destination
+    destination_workers: int = 8
+    # telegram flood limits, messages per second
+    telegram_global_rate: float = 30
+    telegram_chat_rate: float = 1
+    telegram_group_rate: float = 20 / 60
+    # serve the prometheus metrics at http://<host>:<metrics_port>/metrics. None - don't serve
+    metrics_port: int | None = None
 
 
 config = Settings(_env_file=ROOT / 'services/.env')
@@ -1,11 +1,13 @@
 import logging
 from itertools import count
-from typing import AsyncIterable
+from typing import AsyncIterable, Callable
 
 from aiohttp import ClientSession
 from lxml import html
 
-from ..utils import url_to_base64
+from ..images import url_to_digest
+from ..models import Validators
+from ..utils import run_in_pool
 from .interface import ChannelData, Content, DomainMatch, PostUpdate
 
 
@@ -23,7 +25,8 @@ class GrandChallenge(DomainMatch):
             url='https://grand-challenge.org'
         )
 
-    async def update(self, update_url: str, name: str, session: ClientSession) -> AsyncIterable[PostUpdate]:
+    async def update(self, update_url: str, name: str, session: ClientSession, validators: Validators,
+                     known: Callable[[str], bool]) -> AsyncIterable[PostUpdate]:
         for page in count(1):
             url = f'https://grand-challenge.org/challenges/?page={page}'
             async with session.get(url) as response:
@@ -31,19 +34,32 @@ class GrandChallenge(DomainMatch):
                     logger.error('The update link is broken')
                     break
 
-                doc = html.fromstring(await response.text())
+                body = await response.text()
 
-            cards = doc.cssselect('.card.gc-card')
+            cards = await run_in_pool(_parse_cards, body)
             if not cards:
                 break
 
-            for card in cards:
-                link, image, body = card.iterchildren()
-                link = link.attrib['href']
-                image = await url_to_base64(image.cssselect('img')[0].attrib['src'], session)
-                title = body.cssselect('.card-title')[0].text_content().strip()
+            # the challenges are sorted from the newest one, so the next pages are known as well
+            cards = [card for card in cards if not known(card[0])]
+            if not cards:
+                break
 
+            for link, image, title in cards:
+                image = await url_to_digest(image, session)
                 yield PostUpdate(id=link, url=link, content=Content(title=title, image=image))
 
     async def scrape(self, post_url: str, session: ClientSession) -> Content:
         raise NotImplementedError
+
+
+def _parse_cards(page: str) -> list[tuple[str, str, str]]:
+    cards = []
+    for card in html.fromstring(page).cssselect('.card.gc-card'):
+        link, image, body = card.iterchildren()
+        link = link.attrib['href']
+        image = image.cssselect('img')[0].attrib['src']
+        title = body.cssselect('.card-title')[0].text_content().strip()
+        cards.append((link, image, title))
+
+    return cards
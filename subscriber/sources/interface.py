@@ -1,12 +1,14 @@
 from __future__ import annotations
 
 from abc import ABC, abstractmethod
-from typing import AsyncIterable, Optional, Type
-from urllib.parse import urlparse
+from typing import AsyncIterable, Callable, Optional, Type
 
 from aiohttp import ClientSession
 from pydantic import BaseModel
 
+from ..models import Validators
+from ..utils import get_domain
+
 
 TYPE_TO_CHANNEL: dict[str, Type[ChannelAdapter]] = {}
 DOMAIN_TO_CHANNEL = {}
@@ -20,7 +22,7 @@ class VisibleError(Exception):
 class Content(BaseModel):
     title: Optional[str] = None
     description: Optional[str] = None
-    # an optional base64-encoded image
+    # an optional image digest in the storage
     image: Optional[str] = None
 
 
@@ -29,7 +31,7 @@ class ChannelData(BaseModel):
     update_url: str
     # the channel name
     name: str
-    # an optional base64-encoded image
+    # an optional image digest in the storage
     image: Optional[str] = None
     # an optional standardized channel url
     url: Optional[str] = None
@@ -44,6 +46,8 @@ class PostUpdate(BaseModel):
 class ChannelAdapter(ABC):
     queue: str = 'main'
     add_name: bool = False
+    # whether `update` yields the posts starting from the newest one. If so, they are delivered in reverse order
+    newest_first: bool = False
 
     @classmethod
     @abstractmethod
@@ -56,8 +60,14 @@ class ChannelAdapter(ABC):
         """ Get essential channel information based on the provided url """
 
     @abstractmethod
-    async def update(self, update_url: str, name: str, session: ClientSession) -> AsyncIterable[PostUpdate]:
-        """ Get the list of posts for a channel """
+    async def update(self, update_url: str, name: str, session: ClientSession, validators: Validators,
+                     known: Callable[[str], bool]) -> AsyncIterable[PostUpdate]:
+        """
+        Get the list of posts for a channel.
+        `validators` are the http validators of the last response, they should be updated inplace.
+        `known` tells whether a post id was already seen, so that the adapter can skip the extra work
+        (e.g. stop the pagination or don't download the images) for known posts
+        """
         raise NotImplementedError
         # this line is for type checkers:
         yield  # noqa
@@ -92,12 +102,10 @@ class DomainMatch(ChannelAdapter, ABC, abstract=True):
 
     @classmethod
     def match(cls, url: str) -> bool:
-        parts = urlparse(url)
-        domain = '.'.join(parts.netloc.split('.')[-2:]).lower()
         domains = cls.domain
         if isinstance(domains, str):
             domains = domains,
-        return domain in domains
+        return get_domain(url) in domains
 
     def __init_subclass__(cls, **kwargs):
         super().__init_subclass__(**kwargs)
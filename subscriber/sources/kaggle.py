@@ -1,7 +1,8 @@
-from typing import AsyncIterable
+from typing import AsyncIterable, Callable
 
 from aiohttp import ClientSession
 
+from ..models import Validators
 from .interface import ChannelData, Content, DomainMatch, PostUpdate
 
 
@@ -16,7 +17,8 @@ class Kaggle(DomainMatch):
             url='https://www.kaggle.com/competitions'
         )
 
-    async def update(self, update_url: str, name: str, session: ClientSession) -> AsyncIterable[PostUpdate]:
+    async def update(self, update_url: str, name: str, session: ClientSession, validators: Validators,
+                     known: Callable[[str], bool]) -> AsyncIterable[PostUpdate]:
         # FIXME
         import kaggle.api
 
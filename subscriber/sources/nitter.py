@@ -1,16 +1,17 @@
 import re
-from io import BytesIO
-from typing import AsyncIterable
+from typing import AsyncIterable, Callable
 from urllib.parse import urlparse
 
-import feedparser
 from aiohttp import ClientSession
 
+from ..models import Validators
+from ..utils import conditional_get, newest_entries, stream_feed
 from .interface import ChannelData, Content, DomainMatch, PostUpdate
 
 
 class Twitter(DomainMatch):
     domain = 'twitter.com', 'nitter.cz'
+    newest_first = True
 
     GROUP_NAME = re.compile(r'^/(\w+)$', flags=re.IGNORECASE)
     TWEET = re.compile(r'^.*/status/\d+$')
@@ -28,22 +29,25 @@ class Twitter(DomainMatch):
         name = Twitter._username(url)
         return ChannelData(update_url=url, name=name)
 
-    async def update(self, update_url: str, name: str, session: ClientSession) -> AsyncIterable[PostUpdate]:
+    async def update(self, update_url: str, name: str, session: ClientSession, validators: Validators,
+                     known: Callable[[str], bool]) -> AsyncIterable[PostUpdate]:
         base = 'https://nitter.cz/'
         update_url = f'{base}{name}/rss'
 
-        async with session.get(update_url) as response:
-            body = await response.read()
+        async with conditional_get(update_url, session, validators) as response:
+            if response is None:
+                return
 
-        for post in feedparser.parse(BytesIO(body))['entries']:
-            text = post['title_detail']['value']
-            identifier = link = post['link']
-            assert identifier.startswith(base), identifier
-            identifier = identifier.removeprefix(base)
-            if identifier.endswith('#m'):
-                identifier = identifier.removesuffix('#m')
-
-            yield PostUpdate(id=identifier, url=link, content=Content(description=text))
+            async for post in newest_entries(stream_feed(response), lambda post: known(_identifier(post, base))):
+                yield PostUpdate(id=_identifier(post, base), url=post['link'], content=Content(
+                    description=post['title']
+                ))
 
     async def scrape(self, post_url: str, session: ClientSession) -> Content:
         raise NotImplementedError
+
+
+def _identifier(post: dict, base: str) -> str:
+    link = post['link']
+    assert link.startswith(base), link
+    return link.removeprefix(base).removesuffix('#m')
@@ -1,14 +1,17 @@
-from io import BytesIO
-from typing import AsyncIterable
+from typing import AsyncIterable, Callable
 
 import feedparser
 from aiohttp import ClientSession
 
-from ..utils import url_to_base64
+from ..images import url_to_digest
+from ..models import Validators
+from ..utils import conditional_get, newest_entries, stream_feed
 from .interface import ChannelAdapter, ChannelData, Content, PostUpdate
 
 
 class RSS(ChannelAdapter):
+    newest_first = True
+
     @classmethod
     def match(cls, url: str) -> bool:
         feed = feedparser.parse(url)
@@ -18,17 +21,19 @@ class RSS(ChannelAdapter):
     async def track(cls, url: str) -> ChannelData:
         feed = feedparser.parse(url)['feed']
         async with ClientSession() as session:
-            image = await url_to_base64(feed.get('image', {}).get('href'), session)
+            image = await url_to_digest(feed.get('image', {}).get('href'), session)
         return ChannelData(update_url=url, name=feed['title'], image=image, url=url)
 
-    async def update(self, update_url: str, name: str, session: ClientSession) -> AsyncIterable[PostUpdate]:
-        async with session.get(update_url) as response:
-            body = await response.read()
+    async def update(self, update_url: str, name: str, session: ClientSession, validators: Validators,
+                     known: Callable[[str], bool]) -> AsyncIterable[PostUpdate]:
+        async with conditional_get(update_url, session, validators) as response:
+            if response is None:
+                return
 
-        for post in reversed(feedparser.parse(BytesIO(body))['entries']):
-            yield PostUpdate(id=post['id'], url=post['link'], content=Content(
-                title=post['title'], description=post['summary'],
-            ))
+            async for post in newest_entries(stream_feed(response), lambda post: known(post['id'])):
+                yield PostUpdate(id=post['id'], url=post['link'], content=Content(
+                    title=post['title'], description=post['summary'],
+                ))
 
     async def scrape(self, post_url: str, session: ClientSession) -> Content:
         raise NotImplementedError
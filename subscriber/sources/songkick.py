@@ -1,12 +1,14 @@
 import logging
 from pathlib import Path
-from typing import AsyncIterable
+from typing import AsyncIterable, Callable
 from urllib.parse import ParseResult, urlparse, urlunparse
 
 from aiohttp import ClientSession
 from lxml import html
 
-from ..utils import url_to_base64
+from ..images import url_to_digest
+from ..models import Validators
+from ..utils import conditional_get, run_in_pool
 from .interface import ChannelData, Content, DomainMatch, PostUpdate
 
 
@@ -41,42 +43,54 @@ class SongKick(DomainMatch):
                 image = f'https:{image}'
             else:
                 image = f'https://www.songkick.com/{image}'
-            image = await url_to_base64(image, session)
+            image = await url_to_digest(image, session)
 
             calendar = urlunparse(ParseResult(parsed.scheme, parsed.netloc, str(Path(*parts, 'calendar')), '', '', ''))
             return ChannelData(update_url=calendar, name=name, image=image, url=url)
 
-    async def update(self, update_url: str, name: str, session: ClientSession) -> AsyncIterable[PostUpdate]:
-        async with session.get(update_url) as response:
-            doc = html.fromstring(await response.text())
-
-        summary = doc.cssselect('#calendar-summary')
-        if not summary:
-            return
-        if len(summary) > 1:
-            logger.error('"#calendar-summary" has too many elements: %d', len(summary))
-            return
-
-        summary, = summary
-        for element in reversed(summary.cssselect('li.event-listing')):
-            link, = element.cssselect('a')
-            time, = link.cssselect('time')
-            details, = link.cssselect('.event-details')
-            location, = details.cssselect('.primary-detail')
-            venue, = details.cssselect('.secondary-detail')
-
-            location, venue = location.text_content().strip(), venue.text_content().strip()
-            time = time.attrib.get('datetime', '').strip()
-            # text = ''.join((html.tostring(x, encoding='utf-8').decode() for x in text.getchildren()))
-            suffix = link.attrib.get('href', '')
-            assert suffix
-            link = f'https://www.songkick.com/{suffix}#{name}'
-
-            desc = venue
-            if time:
-                desc += ' at ' + time
+    async def update(self, update_url: str, name: str, session: ClientSession, validators: Validators,
+                     known: Callable[[str], bool]) -> AsyncIterable[PostUpdate]:
+        async with conditional_get(update_url, session, validators) as response:
+            if response is None:
+                return
+            body = await response.text()
 
+        for suffix, location, desc in await run_in_pool(_parse_calendar, body):
+            link = f'https://www.songkick.com/{suffix}#{name}'
             yield PostUpdate(id=suffix, url=link, content=Content(title=location, description=desc))
 
     async def scrape(self, post_url: str, session: ClientSession) -> Content:
         raise NotImplementedError
+
+
+def _parse_calendar(body: str) -> list[tuple[str, str, str]]:
+    doc = html.fromstring(body)
+    summary = doc.cssselect('#calendar-summary')
+    if not summary:
+        return []
+    if len(summary) > 1:
+        logger.error('"#calendar-summary" has too many elements: %d', len(summary))
+        return []
+
+    summary, = summary
+    events = []
+    for element in reversed(summary.cssselect('li.event-listing')):
+        link, = element.cssselect('a')
+        time, = link.cssselect('time')
+        details, = link.cssselect('.event-details')
+        location, = details.cssselect('.primary-detail')
+        venue, = details.cssselect('.secondary-detail')
+
+        location, venue = location.text_content().strip(), venue.text_content().strip()
+        time = time.attrib.get('datetime', '').strip()
+        # text = ''.join((html.tostring(x, encoding='utf-8').decode() for x in text.getchildren()))
+        suffix = link.attrib.get('href', '')
+        assert suffix
+
+        desc = venue
+        if time:
+            desc += ' at ' + time
+
+        events.append((suffix, location, desc))
+
+    return events
@@ -4,7 +4,7 @@ import tempfile
 import time
 from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import AsyncIterable
+from typing import AsyncIterable, Callable
 from urllib.parse import urlparse
 
 from aiohttp import ClientSession
@@ -15,7 +15,8 @@ from selenium.webdriver import FirefoxProfile
 from selenium.webdriver.firefox.options import Options
 from selenium.webdriver.remote.webelement import WebElement
 
-from ..utils import file_to_base64
+from ..models import Validators
+from ..utils import normalize_image, store_file
 from .interface import ChannelData, Content, DomainMatch, PostUpdate
 
 
@@ -50,7 +51,8 @@ class Twitter(DomainMatch):
             raise ValueError(f'{path} is not a valid channel name.')
         return ChannelData(update_url=url, name=name.group(1))
 
-    async def update(self, update_url: str, name: str, session: ClientSession) -> AsyncIterable[PostUpdate]:
+    async def update(self, update_url: str, name: str, session: ClientSession, validators: Validators,
+                     known: Callable[[str], bool]) -> AsyncIterable[PostUpdate]:
         results = await asyncio.wrap_future(self._pool.submit(self._update, update_url))
         for result in results:
             yield result
@@ -90,7 +92,7 @@ class Twitter(DomainMatch):
                             tweet.screenshot(file)
                             yield PostUpdate(
                                 id=link, url=link,
-                                content=Content(image=file_to_base64(file)),
+                                content=Content(image=store_file(normalize_image(Path(file)))),
                             )
                             break
 
@@ -1,11 +1,13 @@
 import re
-from typing import AsyncIterable
+from typing import AsyncIterable, Callable
 from urllib.parse import urlparse
 
 from aiohttp import ClientSession
 from lxml import html
 
-from ..utils import url_to_base64
+from ..images import url_to_digest
+from ..models import Validators
+from ..utils import conditional_get, run_in_pool
 from .interface import ChannelData, Content, DomainMatch, PostUpdate
 
 
@@ -23,16 +25,15 @@ class VK(DomainMatch):
             raise ValueError(f'{path} is not a valid channel name.')
         return ChannelData(update_url=url, name=name.group(1))
 
-    async def update(self, update_url: str, name: str, session: ClientSession) -> AsyncIterable[PostUpdate]:
-        async with session.get(update_url) as response:
-            doc = html.fromstring(await response.text())
+    async def update(self, update_url: str, name: str, session: ClientSession, validators: Validators,
+                     known: Callable[[str], bool]) -> AsyncIterable[PostUpdate]:
+        async with conditional_get(update_url, session, validators) as response:
+            if response is None:
+                return
+            body = await response.text()
 
-        visited = set()
-        for element in reversed(doc.cssselect('[data-post-id]')):
-            i = element.attrib.get('data-post-id', '')
-            if i.startswith('-') and i not in visited:
-                visited.add(i)
-                yield PostUpdate(id=i[1:], url=f'https://vk.com/wall{i}', content=Content())
+        for i in await run_in_pool(_parse_posts, body):
+            yield PostUpdate(id=i[1:], url=f'https://vk.com/wall{i}', content=Content())
 
     async def scrape(self, post_url: str, session: ClientSession) -> Content:
         return Content()
@@ -49,6 +50,17 @@ class VK(DomainMatch):
         image = post.cssselect('.thumb_link>[data-src_big]')
         if image:
             image = image[0]
-            kw['image'] = url_to_base64(image.attrib['data-src_big'])
+            kw['image'] = url_to_digest(image.attrib['data-src_big'])
 
         return Content(**kw)
+
+
+def _parse_posts(body: str) -> list[str]:
+    doc = html.fromstring(body)
+    visited, posts = set(), []
+    for element in reversed(doc.cssselect('[data-post-id]')):
+        i = element.attrib.get('data-post-id', '')
+        if i.startswith('-') and i not in visited:
+            visited.add(i)
+            posts.append(i)
+    return posts
@@ -1,57 +1,89 @@
 import re
 from collections import Counter
 from io import BytesIO
-from typing import AsyncIterable
+from typing import AsyncIterable, Callable
+from urllib.parse import urlparse
 
 import feedparser
-import requests
 from aiohttp import ClientSession
 
-from ..utils import get_og_tags, url_to_base64
+from ..images import url_to_digest
+from ..models import Validators
+from ..utils import LRU, conditional_get, get_og_tags, newest_entries, run_in_pool, stream_feed
 from .interface import ChannelData, Content, DomainMatch, PostUpdate, VisibleError
 
 
 class YouTube(DomainMatch):
     domain = 'youtube.com'
+    newest_first = True
     CHANNEL_ID_PATTERN = re.compile(r'"browseId":\s*"([^"]+)"')
+    # channel link -> channel data, so that popular channels are resolved only once
+    _channels = LRU(1024)
 
     @classmethod
     async def track(cls, url: str) -> ChannelData:
-        body = (await aget(url)).text
-        channel_ids = Counter(x.group(1) for x in cls.CHANNEL_ID_PATTERN.finditer(body)).most_common(1)
-        if not channel_ids:
-            raise VisibleError('This not a valid youtube channel.')
+        key = _channel_key(url)
+        if key in cls._channels:
+            return cls._channels.get(key)
 
-        tags = get_og_tags(body)
         async with ClientSession() as session:
-            image = await url_to_base64(tags.get('image'), session)
+            async with session.get(url) as response:
+                body = await response.text()
 
-        channel_id = channel_ids[0][0]
-        update_url = f'https://www.youtube.com/feeds/videos.xml?channel_id={channel_id}'
-        normalized_url = f'https://www.youtube.com/channel/{channel_id}'
+            channel_ids = Counter(x.group(1) for x in cls.CHANNEL_ID_PATTERN.finditer(body)).most_common(1)
+            if not channel_ids:
+                raise VisibleError('This not a valid youtube channel.')
 
-        name = feedparser.parse(update_url)['feed']['title']
-        return ChannelData(update_url=update_url, name=name, image=image, url=normalized_url)
+            tags = await run_in_pool(get_og_tags, body)
+            image = await url_to_digest(tags.get('image'), session)
 
-    async def update(self, update_url: str, name: str, session: ClientSession) -> AsyncIterable[PostUpdate]:
-        async with session.get(update_url) as response:
-            body = await response.read()
+            channel_id = channel_ids[0][0]
+            update_url = f'https://www.youtube.com/feeds/videos.xml?channel_id={channel_id}'
+            normalized_url = f'https://www.youtube.com/channel/{channel_id}'
 
-        for post in reversed(feedparser.parse(BytesIO(body))['entries']):
-            yield PostUpdate(id=post['id'], url=post['link'])
+            async with session.get(update_url) as response:
+                name = feedparser.parse(BytesIO(await response.read()))['feed']['title']
+
+        data = ChannelData(update_url=update_url, name=name, image=image, url=normalized_url)
+        cls._channels[_channel_key(normalized_url)] = data
+        if key is not None:
+            cls._channels[key] = data
+        return data
+
+    async def update(self, update_url: str, name: str, session: ClientSession, validators: Validators,
+                     known: Callable[[str], bool]) -> AsyncIterable[PostUpdate]:
+        async with conditional_get(update_url, session, validators) as response:
+            if response is None:
+                return
+
+            async for post in newest_entries(stream_feed(response), lambda post: known(post['id'])):
+                yield PostUpdate(id=post['id'], url=post['link'])
 
     async def scrape(self, post_url: str, session: ClientSession) -> Content:
-        fields = get_og_tags((await aget(post_url)).text)
+        async with session.get(post_url) as response:
+            fields = await run_in_pool(get_og_tags, await response.text())
 
         if 'title' in fields:
             return Content(
                 title=fields['title'], description=fields['description'],
-                image=await url_to_base64(fields['image'], session),
+                image=await url_to_digest(fields['image'], session),
             )
 
         return Content()
 
 
-# TODO: make this truly async
-async def aget(url):
-    return requests.get(url)
+def _channel_key(url: str) -> str | None:
+    # e.g. /@handle/videos -> @handle, /c/name/featured -> c/name
+    parts = [x for x in urlparse(url).path.split('/') if x]
+    if len(parts) >= 2 and parts[0] in ('c', 'user', 'channel'):
+        key = '/'.join(parts[:2])
+    elif parts and parts[0].startswith('@'):
+        key = parts[0]
+    else:
+        # not a channel link, e.g. a video
+        return None
+
+    # only channel ids are case-sensitive
+    if parts[0] != 'channel':
+        key = key.lower()
+    return key
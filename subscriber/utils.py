@@ -1,16 +1,26 @@
-import base64
+import asyncio
+import contextlib
 import re
 import tempfile
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from functools import cache
+from io import BytesIO
 from pathlib import Path
-from typing import Union
+from typing import AsyncIterator, Callable, Union
+from urllib.parse import urlparse
 
 import aiohttp
+import feedparser
 import lxml.html
+from lxml import etree
 from tarn import HashKeyStorage
 
 from subscriber.settings import config
 
+from .models import Validators
+
 
 URL_PATTERN = re.compile(
     r'^(?:http|ftp)s?://'  # http:// or https://
@@ -28,11 +38,134 @@ def build_storage() -> HashKeyStorage:
     return HashKeyStorage(config.storage_path)
 
 
+@cache
+def build_pool() -> ProcessPoolExecutor | None:
+    if config.parse_workers > 0:
+        return ProcessPoolExecutor(config.parse_workers)
+
+
+async def run_in_pool(func, *args):
+    """ Run a CPU-bound `func` in the process pool, so that it doesn't block the event loop """
+    pool = build_pool()
+    if pool is None:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(pool, func, *args)
+
+
 def drop_prefix(x, prefix):
     assert x.startswith(prefix), x
     return x[len(prefix):]
 
 
+def get_domain(url: str) -> str:
+    return '.'.join(urlparse(url).netloc.split('.')[-2:]).lower()
+
+
+class TrackedQueue(asyncio.Queue):
+    """ A queue that remembers its largest size and lets producers wait until it is drained to half its bound """
+
+    def __init__(self, name: str, maxsize: int = 0):
+        super().__init__(maxsize)
+        self.name = name
+        self.high_water = 0
+        self._drained = asyncio.Event()
+        self._drained.set()
+
+    async def drained(self):
+        await self._drained.wait()
+
+    def _put(self, item):
+        super()._put(item)
+        self.high_water = max(self.high_water, self.qsize())
+        if self.maxsize > 0 and self.qsize() >= self.maxsize:
+            self._drained.clear()
+
+    def _get(self):
+        item = super()._get()
+        if self.qsize() <= self.maxsize // 2:
+            self._drained.set()
+        return item
+
+
+class HostLimiter:
+    """ Limits the number of concurrent requests, both globally and per domain """
+
+    def __init__(self, total: int, per_host: int):
+        self._total = asyncio.Semaphore(total)
+        self._hosts = defaultdict(lambda: asyncio.Semaphore(per_host))
+
+    @contextlib.asynccontextmanager
+    async def __call__(self, url: str):
+        # take the host slot first, so that a busy host doesn't hold global slots while waiting
+        async with self._hosts[get_domain(url)], self._total:
+            yield
+
+
+class TokenBucket:
+    """ Allows `rate` events per second on average, with bursts of up to `capacity` events """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate, self.capacity = rate, capacity
+        self._tokens, self._updated = capacity, time.monotonic()
+
+    def delay(self) -> float:
+        """ The number of seconds until a token is available """
+        self._refill()
+        return max(0, (1 - self._tokens) / self.rate)
+
+    def full(self) -> bool:
+        self._refill()
+        return self._tokens >= self.capacity
+
+    def take(self):
+        self._refill()
+        self._tokens -= 1
+
+    def pause(self, seconds: float):
+        """ No tokens will be available for the next `seconds` """
+        self._refill()
+        self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+async def acquire_tokens(*buckets: TokenBucket):
+    """ Wait until all the buckets have a token, then take them at once """
+    while delay := max(bucket.delay() for bucket in buckets):
+        await asyncio.sleep(delay)
+    for bucket in buckets:
+        bucket.take()
+
+
+class LRU:
+    """ A dict-like cache that keeps only the `size` most recently used entries """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self._data:
+            return default
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
 def get_og_tags(html: Union[str, bytes]):
     res = {}
     doc = lxml.html.fromstring(html)
@@ -44,28 +177,192 @@ def get_og_tags(html: Union[str, bytes]):
     return res
 
 
-def file_to_base64(path):
-    with open(path, 'rb') as fd:
-        return base64.b64encode(fd.read())
+# the minimal documents around a single feed entry, by the name of the root element
+FEED_WRAPPERS = {
+    'feed': b'<feed xmlns="http://www.w3.org/2005/Atom">%s</feed>',
+    'rss': b'<rss version="2.0"><channel>%s</channel></rss>',
+    'RDF': b'<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">%s</rdf:RDF>',
+}
+
+
+def parse_feed(body: bytes) -> list[dict]:
+    """ Parse an RSS/Atom feed and keep only the essential fields of its entries """
+    return list(map(_feed_entry, feedparser.parse(BytesIO(body))['entries']))
+
+
+async def stream_feed(response: aiohttp.ClientResponse, chunk_size: int = 16 * 1024,
+                      head: int = 5) -> AsyncIterator[dict]:
+    """
+    Parse the entries of an RSS/Atom feed in document order, while the response body arrives.
+    Only the first `head` entries are parsed here - usually enough to reach the known ones. If the consumer needs more,
+    the whole body is parsed in the process pool. If the consumer stops early, the rest of the body is neither
+    downloaded nor parsed. The entries have the same fields as in `parse_feed`
+    """
+    parser = etree.XMLPullParser(events=('start', 'end'), resolve_entities=False, recover=True)
+    wrapper, chunks, count = None, [], 0
+    async for chunk in response.content.iter_chunked(chunk_size):
+        parser.feed(chunk)
+        chunks.append(chunk)
+
+        for event, element in parser.read_events():
+            if wrapper is None:
+                wrapper = FEED_WRAPPERS.get(etree.QName(element).localname, b'')
+                continue
+            if not wrapper:
+                break
+
+            parent = element.getparent()
+            if event == 'end' and etree.QName(element).localname in ('entry', 'item') and parent is not None and (
+                    parent.getparent() is None or etree.QName(parent).localname == 'channel'
+            ):
+                entry, = feedparser.parse(wrapper % etree.tostring(element))['entries']
+                # free the memory of the parsed entries
+                element.clear(keep_tail=True)
+                while element.getprevious() is not None:
+                    del parent[0]
+
+                count += 1
+                yield _feed_entry(entry)
+                if count >= head:
+                    break
+
+        if wrapper == b'' or count >= head:
+            break
+
+    # an unknown feed format, or too many entries to parse them in the event loop
+    if wrapper == b'' or count >= head:
+        async for chunk in response.content.iter_chunked(chunk_size):
+            chunks.append(chunk)
+        for entry in (await run_in_pool(parse_feed, b''.join(chunks)))[count:]:
+            yield entry
+
+
+async def newest_entries(entries: AsyncIterator[dict], known: Callable[[dict], bool]) -> AsyncIterator[dict]:
+    """
+    Yield the feed entries starting from the newest one, oldest-first feeds are read till the end and reversed.
+    The rest of the feed is skipped at the first known entry, but only while the dates prove the descending order:
+    missing dates or a pinned entry make it read the whole feed
+    """
+    head = []
+    async for entry in entries:
+        head.append(entry)
+        if len(head) == 2:
+            break
+
+    dates = [entry['date'] for entry in head]
+    if len(head) == 2 and None not in dates and dates[0] < dates[1]:
+        head.extend([entry async for entry in entries])
+        for entry in reversed(head):
+            yield entry
+        return
+
+    ordered, proven, previous = True, False, None
+
+    def done(entry) -> bool:
+        nonlocal ordered, proven, previous
+        date = entry['date']
+        if date is None or (previous is not None and date > previous):
+            ordered = False
+        elif previous is not None and date < previous:
+            proven = True
+        previous = date
+        return ordered and proven and known(entry)
+
+    for entry in head:
+        if done(entry):
+            return
+        yield entry
+    async for entry in entries:
+        if done(entry):
+            return
+        yield entry
 
 
-def store_base64(encoded):
+def _feed_entry(entry) -> dict:
+    result = {key: entry[key] for key in ('id', 'link', 'title', 'summary') if key in entry}
+    date = entry.get('published_parsed') or entry.get('updated_parsed')
+    result['date'] = None if date is None else tuple(date)
+    return result
+
+
+def normalize_image(path: Path) -> Path:
+    """ Downscale and re-encode the image according to the config. Returns the path to the resulting file """
+    if config.image_max_size is None:
+        return path
+
+    from PIL import Image, ImageOps, UnidentifiedImageError
+
+    target = path.with_name(path.name + '.normalized')
+    try:
+        with Image.open(path) as image:
+            fits = max(image.size) <= config.image_max_size
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((config.image_max_size, config.image_max_size))
+            if config.image_format.lower() in ('jpeg', 'jpg') and image.mode != 'RGB':
+                # jpeg has no transparency
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, 'white')
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+
+            image.save(target, format=config.image_format, quality=config.image_quality, optimize=True)
+
+    except (UnidentifiedImageError, OSError):
+        # not an image that Pillow can handle
+        return path
+
+    # re-encoding a small image doesn't always help
+    if fits and target.stat().st_size >= path.stat().st_size:
+        return path
+    return target
+
+
+def store_file(path: Union[str, Path]) -> str:
+    return build_storage().write(Path(path)).hex()
+
+
+async def store_stream(chunks: AsyncIterator[bytes]) -> str:
+    """ Write the chunks into the storage, computing the digest as they arrive """
+    storage = build_storage()
+    hasher = storage.algorithm()
     with tempfile.TemporaryDirectory() as folder:
         file = Path(folder, 'file')
-
         with open(file, 'wb') as fd:
-            fd.write(base64.b64decode(encoded))
+            async for chunk in chunks:
+                hasher.update(chunk)
+                fd.write(chunk)
 
-        return build_storage().write(file).hex()
+        if config.image_max_size is not None:
+            # the digest of the normalized image is computed by the storage
+            return await asyncio.to_thread(store_file, await run_in_pool(normalize_image, file))
+
+        digest = hasher.hexdigest()
+        # already stored files don't need to be copied again
+        if storage.read(lambda x: x, digest, error=False) is None:
+            await asyncio.to_thread(store_file, file)
+
+    return digest
 
 
 def storage_resolve(key):
     return build_storage().read(lambda x: x, key)
 
 
-async def url_to_base64(url: str | None, session: aiohttp.ClientSession) -> str | None:
-    if url is None:
-        return
+@contextlib.asynccontextmanager
+async def conditional_get(url: str, session: aiohttp.ClientSession, validators: Validators):
+    """ Yields the response, or None if the content didn't change since the last request """
+    headers = {}
+    if validators.etag is not None:
+        headers['If-None-Match'] = validators.etag
+    if validators.last_modified is not None:
+        headers['If-Modified-Since'] = validators.last_modified
+
+    async with session.get(url, headers=headers) as response:
+        if response.status == 304:
+            yield None
+            return
 
-    async with session.get(url) as response:
-        return base64.b64encode(await response.read())
+        if response.ok:
+            validators.etag = response.headers.get('ETag')
+            validators.last_modified = response.headers.get('Last-Modified')
+        yield response
@@ -0,0 +1,143 @@
+import hashlib
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from bisect import bisect_left, insort
+from pathlib import Path
+from typing import Iterable
+
+
+MAGIC = b'VIS1'
+
+
+class VisitedIds:
+    """
+    The most recently seen post ids of a single source, stored as 64-bit hashes.
+    Only the `size` most recently added ids are kept, the older ones are caught by the
+    unique (identifier, source_id) constraint of the posts table
+    """
+    __slots__ = '_ring', '_keys', '_oldest', '_size'
+
+    def __init__(self, size: int, hashes: Iterable[int] = ()):
+        self._size = size
+        # the hashes in the order they were added, overwritten starting from the oldest one once full
+        self._ring = array('Q')
+        self._oldest = 0
+        # the same hashes, sorted for lookups. Python ints would take ~10 times more memory
+        self._keys = array('Q')
+        for key in hashes:
+            self._push(key)
+
+    def __contains__(self, identifier: str) -> bool:
+        return self._find(_hash(identifier)) is not None
+
+    def add(self, identifier: str):
+        self._push(_hash(identifier))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def memory(self) -> int:
+        """ The approximate number of bytes used """
+        return sys.getsizeof(self._ring) + sys.getsizeof(self._keys)
+
+    def hashes(self) -> array:
+        """ From the oldest to the newest one """
+        return self._ring[self._oldest:] + self._ring[:self._oldest]
+
+    def _find(self, key: int) -> int | None:
+        index = bisect_left(self._keys, key)
+        if index < len(self._keys) and self._keys[index] == key:
+            return index
+        return None
+
+    def _push(self, key: int):
+        if self._size <= 0 or self._find(key) is not None:
+            return
+
+        if len(self._ring) < self._size:
+            self._ring.append(key)
+        else:
+            del self._keys[self._find(self._ring[self._oldest])]
+            self._ring[self._oldest] = key
+            self._oldest = (self._oldest + 1) % self._size
+        insort(self._keys, key)
+
+
+class VisitedIndex:
+    """ The visited post ids for all the sources """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._sources: dict[int, VisitedIds] = {}
+
+    def __getitem__(self, source_pk: int) -> VisitedIds:
+        if source_pk not in self._sources:
+            self._sources[source_pk] = VisitedIds(self.size)
+        return self._sources[source_pk]
+
+    def update(self, sources: dict[int, Iterable[str]]):
+        for pk, identifiers in sources.items():
+            visited = self[pk]
+            for identifier in identifiers:
+                visited.add(identifier)
+
+    def memory(self) -> dict[int, int]:
+        return {pk: visited.memory() for pk, visited in self._sources.items()}
+
+    def snapshot(self) -> dict[int, array]:
+        """ A copy of the hashes that can be dumped from another thread """
+        return {pk: visited.hashes() for pk, visited in self._sources.items()}
+
+    def save(self, path: Path):
+        self.dump(path, self.snapshot())
+
+    @staticmethod
+    def dump(path: Path, snapshot: dict[int, array]):
+        """ Atomically dump the index as: magic, then (pk, count, hashes) for each source, in native byte order """
+        # a separate file for each writer, in case a previous dump is still running
+        handle, temp = tempfile.mkstemp(suffix='.tmp', prefix=path.name + '.', dir=path.parent)
+        try:
+            with open(handle, 'wb') as fd:
+                fd.write(MAGIC)
+                for pk, hashes in snapshot.items():
+                    fd.write(struct.pack('=QQ', pk, len(hashes)))
+                    fd.write(hashes.tobytes())
+
+                # the data must reach the disk before the rename, otherwise a crash can leave an empty file
+                fd.flush()
+                os.fsync(fd.fileno())
+
+            os.replace(temp, path)
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+    @classmethod
+    def load(cls, path: Path, size: int):
+        index = cls(size)
+        with open(path, 'rb') as fd:
+            data = fd.read()
+
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a visited index')
+
+        offset, header = len(MAGIC), struct.calcsize('=QQ')
+        while offset < len(data):
+            if offset + header > len(data):
+                raise ValueError(f'{path} is truncated')
+            pk, count = struct.unpack_from('=QQ', data, offset)
+            offset += header
+            if offset + count * 8 > len(data):
+                raise ValueError(f'{path} is truncated')
+            hashes = array('Q', data[offset:offset + count * 8])
+            offset += count * 8
+            index._sources[pk] = VisitedIds(size, hashes)
+
+        return index
+
+
+def _hash(identifier: str) -> int:
+    return int.from_bytes(hashlib.blake2b(identifier.encode(), digest_size=8).digest(), 'little')
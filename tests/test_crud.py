@@ -0,0 +1,228 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select
+
+from subscriber import crud
+from subscriber.base import db, make_engine, session_maker
+from subscriber.migrations import migrate
+from subscriber.models import ChatPost, ChatPostState, ChatTable, File, Outbox, PostTable, SourceTable
+from subscriber.settings import config
+from subscriber.sources import ChannelData, Content, PostUpdate
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'db_path', tmp_path / 'db.sqlite3')
+    make_engine.cache_clear()
+    session_maker.cache_clear()
+    migrate(make_engine())
+    yield
+    make_engine().dispose()
+    make_engine.cache_clear()
+    session_maker.cache_clear()
+
+
+async def add_source(name: str, *chats: str, chat_type: str = 'Telegram', image: str | None = None):
+    for chat in chats:
+        await crud.subscribe(
+            chat, chat_type, 'RSS', f'https://{name}', ChannelData(update_url=f'https://{name}', name=name, image=image)
+        )
+    source, = [source for _, source in await crud.list_all_sources() if source.name == name]
+    return source
+
+
+def update(identifier: str, image: str | None = None) -> PostUpdate:
+    return PostUpdate(id=identifier, url=f'https://post/{identifier}', content=Content(title=identifier, image=image))
+
+
+async def deliver(message_ids: dict[str, str]) -> list[int]:
+    """ Claim the outbox and save the chat posts under the given message id for each chat """
+    result = []
+    for chat_id, chat_pk, post_pk, _, _, _ in await crud.claim_outbox('Telegram', 100):
+        _, pk = await crud.save_chat_post(chat_pk, post_pk, message_ids[chat_id])
+        result.append(pk)
+    return result
+
+
+def outbox() -> set[tuple[str, str, str]]:
+    """ (chat, source, post) for each outbox entry """
+    with db() as session:
+        return set(session.execute(
+            select(ChatTable.identifier, SourceTable.name, PostTable.identifier)
+            .join(Outbox, Outbox.chat_id == ChatTable.id).join(PostTable, PostTable.id == Outbox.post_id)
+            .join(SourceTable, SourceTable.id == PostTable.source_id)
+        ).all())
+
+
+def states() -> dict[tuple[str, str], ChatPostState]:
+    with db() as session:
+        return {
+            (chat_post.chat.identifier, chat_post.post.identifier): chat_post.state
+            for chat_post in session.scalars(select(ChatPost))
+        }
+
+
+@pytest.mark.asyncio
+async def test_save_posts(database):
+    a = await add_source('a', 'A', 'B')
+    b = await add_source('b', 'B')
+    await add_source('b', 'S', chat_type='Slack')
+    quiet = await add_source('c', 'A')
+    assert await crud.save_posts([(a, update('x'), True)]) == {'Telegram'}
+
+    assert await crud.save_posts([
+        # already saved
+        (a, update('x'), True),
+        # twice in the same batch
+        (a, update('y', 'digest'), True), (a, update('y'), True),
+        # the same id in another source
+        (b, update('y'), True),
+        # the first update of a source doesn't notify
+        (quiet, update('z'), False),
+    ]) == {'Telegram', 'Slack'}
+
+    assert outbox() == {
+        ('A', 'a', 'x'), ('B', 'a', 'x'), ('A', 'a', 'y'), ('B', 'a', 'y'), ('B', 'b', 'y'), ('S', 'b', 'y'),
+    }
+    with db() as session:
+        posts = {(post.source.name, post.identifier): post for post in session.scalars(select(PostTable))}
+        assert set(posts) == {('a', 'x'), ('a', 'y'), ('b', 'y'), ('c', 'z')}
+        # the first update wins
+        assert posts['a', 'y'].image.internal == 'digest'
+
+
+@pytest.mark.asyncio
+async def test_outbox(database):
+    source = await add_source('a', 'A', 'B', image='source')
+    await crud.save_posts([(source, update('x', 'own'), True), (source, update('y'), True)])
+
+    first = await crud.claim_outbox('Telegram', 3)
+    assert [(chat, post.title) for chat, *_, post in first] == [('A', 'x'), ('B', 'x'), ('A', 'y')]
+    # the posts are shared between chats, the source image is the fallback
+    assert first[0][-1] is first[1][-1]
+    assert first[0][-1].image == File(internal='own', telegram=None)
+    assert first[2][-1].image == File(internal='source', telegram=None)
+    # the claimed entries are skipped
+    assert [(chat, post.title) for chat, *_, post in await crud.claim_outbox('Telegram', 3)] == [('B', 'y')]
+    assert await crud.claim_outbox('Telegram', 3) == []
+    assert await crud.claim_outbox('Slack', 3) == []
+
+    # sent or failed
+    for _, chat_pk, post_pk, *_ in first[:2]:
+        await crud.ack_outbox(chat_pk, post_pk)
+    _, chat_pk, post_pk, *_ = first[2]
+    await crud.save_chat_post(chat_pk, post_pk, '1')
+    # a restart returns the remaining entry
+    await crud.reset_outbox()
+    assert [(chat, post.title) for chat, *_, post in await crud.claim_outbox('Telegram', 3)] == [('B', 'y')]
+    assert outbox() == {('B', 'a', 'y')}
+
+
+@pytest.mark.asyncio
+async def test_keep_delete_per_chat(database):
+    # the same message id in different chats
+    source = await add_source('b', 'B')
+    await crud.save_posts([(source, update('w'), True)])
+    await deliver({'B': '5'})
+    source = await add_source('a', 'A')
+    await crud.save_posts([(source, update(x), True) for x in 'xyz'])
+    await deliver({'A': '5'})
+
+    await crud.keep('A', '5', 1)
+    assert states() == {
+        ('A', 'x'): ChatPostState.Keeping, ('A', 'y'): ChatPostState.Posted, ('A', 'z'): ChatPostState.Posted,
+        ('B', 'w'): ChatPostState.Posted,
+    }
+    await crud.delete('A', '5')
+    assert states()['B', 'w'] == ChatPostState.Posted
+    assert states()['A', 'y'] == ChatPostState.Deleted
+
+
+@pytest.mark.asyncio
+async def test_expire_digest(database):
+    source = await add_source('a', 'A', 'B')
+    with db() as session:
+        session.query(ChatTable).update({ChatTable.ttl: 0})
+    await crud.save_posts([(source, update(x), True) for x in 'xyz'])
+    ids = await deliver({'A': '1', 'B': '2'})
+    await crud.keep('B', '2', 2)
+
+    # the posts of a digest expire in separate batches, but the message is removed once
+    assert await crud.expire_posts(ids[:2]) == [('Telegram', 'A', '1')]
+    assert await crud.expire_posts(ids[2:]) == []
+    # a digest with a kept post stays
+    assert states() == {
+        ('A', 'x'): ChatPostState.Deleted, ('A', 'y'): ChatPostState.Deleted, ('A', 'z'): ChatPostState.Deleted,
+        ('B', 'x'): ChatPostState.Deleted, ('B', 'y'): ChatPostState.Keeping, ('B', 'z'): ChatPostState.Deleted,
+    }
+
+
+@pytest.mark.asyncio
+async def test_retry_outbox(database):
+    source = await add_source('a', 'A')
+    await crud.save_posts([(source, update('x'), True)])
+    (_, chat_pk, post_pk, *_), = await crud.claim_outbox('Telegram', 100)
+
+    # not due yet
+    assert await crud.retry_outbox(chat_pk, post_pk, 60, 3)
+    assert await crud.claim_outbox('Telegram', 100) == []
+    # due right away
+    assert await crud.retry_outbox(chat_pk, post_pk, 0, 3)
+    assert len(await crud.claim_outbox('Telegram', 100)) == 1
+    # no attempts left
+    assert not await crud.retry_outbox(chat_pk, post_pk, 0, 3)
+    await crud.reset_outbox()
+    assert await crud.claim_outbox('Telegram', 100) == []
+
+
+@pytest.mark.asyncio
+async def test_digest(database):
+    source = await add_source('a', 'A', 'B')
+    await crud.set_digest('A', 'Telegram', 600)
+    await crud.save_posts([(source, update(x), True) for x in 'xyz'])
+    claimed = await crud.claim_outbox('Telegram', 100)
+    assert {(chat, digest) for chat, _, _, digest, *_ in claimed} == {('A', 600), ('B', None)}
+    for chat_id, chat_pk, post_pk, *_ in claimed:
+        await crud.save_chat_post(chat_pk, post_pk, '1' if chat_id == 'A' else str(post_pk))
+
+    # the posts are numbered in the order they were sent
+    await crud.keep('A', '1', 3)
+    await crud.keep('A', '1', 4)
+    assert [post for (chat, post), state in states().items() if state == ChatPostState.Keeping] == ['z']
+    # the whole message
+    await crud.keep('A', '1')
+    assert [chat for (chat, _), state in states().items() if state == ChatPostState.Posted] == ['B'] * 3
+
+
+def add_posts(source_pk: int, *created: datetime):
+    with db() as session:
+        count = session.query(PostTable).where(PostTable.source_id == source_pk).count()
+        for i, date in enumerate(created, count):
+            session.add(PostTable(source_id=source_pk, identifier=str(i), url=f'https://post/{i}', created=date))
+
+
+@pytest.mark.asyncio
+async def test_list_sources_and_posts(database):
+    a, b = await add_source('a', 'A'), await add_source('b', 'A')
+    await add_source('c', 'A')
+    now = datetime.utcnow()
+    add_posts(a.pk, *[now] * 5)
+    add_posts(b.pk, now)
+    # the latest posts of each source
+    assert await crud.list_sources_and_posts(3) == {a.pk: {'2', '3', '4'}, b.pk: {'0'}}
+
+
+@pytest.mark.asyncio
+async def test_get_post_rates(database):
+    a, b = await add_source('a', 'A'), await add_source('b', 'A')
+    now = datetime.utcnow()
+    # the history found by the first poll doesn't count
+    add_posts(a.pk, *[now - timedelta(days=3, minutes=i) for i in range(3)])
+    add_posts(a.pk, *[now - timedelta(hours=i) for i in range(4)])
+    add_posts(b.pk, now)
+
+    rates = await crud.get_post_rates(timedelta(days=7))
+    # a young source is measured over its lifetime
+    assert rates[a.pk] * 3 * 24 * 60 * 60 == pytest.approx(4, rel=1e-3)
+    assert rates[b.pk] == 0
@@ -0,0 +1,77 @@
+import asyncio
+import time
+from asyncio import Queue
+
+import pytest
+
+from subscriber.destinations import Destination, Telegram, Throttled
+from subscriber.entrypoints import run_destination
+from subscriber.models import Remove
+from subscriber.settings import config
+from subscriber.utils import TokenBucket, acquire_tokens
+
+
+class Flood(Destination):
+    def __init__(self):
+        self.removed, self.paused = [], {}
+
+    def ready_at(self, chat_id):
+        return self.paused.get(chat_id, 0)
+
+    async def notify(self, chat_id, post):
+        raise NotImplementedError
+
+    async def remove(self, chat_id, message_id):
+        # the first request to the chat hits the flood limit
+        if chat_id == 'slow' and chat_id not in self.paused:
+            self.paused[chat_id] = time.monotonic() + 0.2
+            raise Throttled(chat_id)
+        self.removed.append((chat_id, message_id))
+
+
+@pytest.mark.asyncio
+async def test_throttled_chat(monkeypatch):
+    monkeypatch.setattr(config, 'destination_workers', 1)
+    destination, queue = Flood(), Queue()
+    for chat_id, message_id in [('slow', '1'), ('slow', '2'), ('fast', '3')]:
+        queue.put_nowait(Remove(chat_id, message_id))
+
+    task = asyncio.create_task(run_destination(destination, queue, None))
+    try:
+        await asyncio.wait_for(queue.join(), 1)
+    finally:
+        task.cancel()
+
+    # the other chats don't wait for the throttled one, which keeps its order
+    assert destination.removed == [('fast', '3'), ('slow', '1'), ('slow', '2')]
+
+
+class Limited(Destination):
+    # the same per-chat buckets as the Telegram destination
+    ready_at = Telegram.ready_at
+
+    def __init__(self):
+        self.removed, self._chats = [], {}
+
+    async def notify(self, chat_id, post):
+        raise NotImplementedError
+
+    async def remove(self, chat_id, message_id):
+        await acquire_tokens(self._chats.setdefault(chat_id, TokenBucket(20)))
+        self.removed.append((chat_id, message_id))
+
+
+@pytest.mark.asyncio
+async def test_rate_limited_chat(monkeypatch):
+    monkeypatch.setattr(config, 'destination_workers', 1)
+    destination, queue = Limited(), Queue()
+    for message_id in '123':
+        queue.put_nowait(Remove('chat', message_id))
+
+    task = asyncio.create_task(run_destination(destination, queue, None))
+    try:
+        await asyncio.wait_for(queue.join(), 1)
+    finally:
+        task.cancel()
+
+    assert destination.removed == [('chat', '1'), ('chat', '2'), ('chat', '3')]
@@ -0,0 +1,25 @@
+from subscriber.metrics import Counter, Gauge, Histogram
+
+
+def test_render():
+    counter = Counter('test_total', 'Test', ('type',))
+    counter.inc('rss')
+    counter.inc('rss', value=2)
+    counter.inc('a "quoted"\nname')
+    assert counter.render().splitlines() == [
+        '# HELP test_total Test', '# TYPE test_total counter',
+        'test_total{type="rss"} 3', r'test_total{type="a \"quoted\"\nname"} 1',
+    ]
+
+    gauge = Gauge('test_size', 'Test')
+    gauge.track(lambda: 5)
+    assert gauge.render().splitlines()[-1] == 'test_size 5'
+
+    histogram = Histogram('test_seconds', 'Test', ('type',), buckets=(1, 2))
+    for value in [0.5, 1, 1.5, 3]:
+        histogram.observe(value, 'rss')
+    assert histogram.render().splitlines()[2:] == [
+        'test_seconds_bucket{type="rss",le="1"} 2', 'test_seconds_bucket{type="rss",le="2"} 3',
+        'test_seconds_bucket{type="rss",le="+Inf"} 4', 'test_seconds_sum{type="rss"} 6.0',
+        'test_seconds_count{type="rss"} 4',
+    ]
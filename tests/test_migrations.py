@@ -0,0 +1,33 @@
+from sqlalchemy import create_engine, inspect, text
+
+from subscriber.migrations import MIGRATIONS, get_version, migrate
+from subscriber.models import Base
+
+
+def test_migrate(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "db.sqlite3"}')
+    # a database from before the versioning: no indexes and a missing column
+    with engine.begin() as connection:
+        Base.metadata.create_all(connection)
+        for index in ['ix_ChatPost_message_id', 'ix_ChatPost_state_deadline', 'ix_Post_source_id_id']:
+            connection.execute(text(f'DROP INDEX "{index}"'))
+        connection.execute(text('ALTER TABLE "Chat" DROP COLUMN digest'))
+        connection.execute(text('ALTER TABLE "Outbox" DROP COLUMN attempts'))
+
+    migrate(engine)
+    migrate(engine)
+    with engine.connect() as connection:
+        assert get_version(connection) == len(MIGRATIONS)
+        inspector = inspect(connection)
+        assert 'digest' in {column['name'] for column in inspector.get_columns('Chat')}
+        assert {'attempts', 'retry_at'} <= {column['name'] for column in inspector.get_columns('Outbox')}
+        assert 'ix_ChatPost_message_id' in {index['name'] for index in inspector.get_indexes('ChatPost')}
+        assert 'ix_Post_source_id_id' in {index['name'] for index in inspector.get_indexes('Post')}
+
+
+def test_create(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "db.sqlite3"}')
+    migrate(engine)
+    with engine.connect() as connection:
+        assert get_version(connection) == len(MIGRATIONS)
+        assert set(inspect(connection).get_table_names()) == set(Base.metadata.tables)
@@ -0,0 +1,83 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from subscriber.models import Source
+from subscriber.scheduler import ExpiryScheduler, PollScheduler
+
+
+def make_source(pk):
+    return Source(pk=pk, name=str(pk), type='RSS', update_url=f'https://example.com/{pk}')
+
+
+def test_interval():
+    scheduler = PollScheduler(10, 1000, 2, 0)
+    scheduler.update([], {1: 0.01, 2: 1, 3: 0})
+    assert scheduler.interval(1) == 50
+    assert scheduler.interval(2) == 10
+    assert scheduler.interval(3) == 1000
+
+    # backoff
+    scheduler.update([(True, make_source(1))], {1: 0.01})
+    scheduler.done(1, False)
+    scheduler.done(1, False)
+    assert scheduler.interval(1) == 200
+    scheduler.done(1, True)
+    assert scheduler.interval(1) == 50
+
+
+@pytest.mark.asyncio
+async def test_next():
+    scheduler = PollScheduler(0.01, 0.05, 1, 0.1)
+    scheduler.update([(False, make_source(i)) for i in range(3)], {})
+    polled = [(await scheduler.next())[1].pk for _ in range(3)]
+    assert sorted(polled) == [0, 1, 2]
+
+    # new subscriptions are polled right away
+    scheduler.update([(False, make_source(i)) for i in range(4)], {})
+    assert (await asyncio.wait_for(scheduler.next(), 0.005))[1].pk == 3
+
+    # nothing is due until the polls are done
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(scheduler.next(), 0.1)
+
+    scheduler.done(1, True)
+    assert (await asyncio.wait_for(scheduler.next(), 0.1))[1].pk == 1
+
+
+@pytest.mark.asyncio
+async def test_expiry():
+    now = datetime.utcnow()
+    entries = [(now - timedelta(seconds=10 - i), i) for i in range(5)] + [(now + timedelta(seconds=0.05), 5)]
+    loads = []
+
+    async def load(after, limit):
+        loads.append(after)
+        return [x for x in sorted(entries) if after is None or x > after][:limit]
+
+    expiry = ExpiryScheduler(load, 2)
+    # nothing is loaded yet
+    expiry.add(now - timedelta(seconds=100), 100)
+    assert await expiry.next() == [0, 1]
+    # before the cursor
+    expiry.add(now - timedelta(seconds=100), 101)
+    # after the cursor - will be loaded later
+    entries.append((now - timedelta(seconds=1), 102))
+    expiry.add(*entries[-1])
+
+    assert await expiry.next() == [101]
+    assert await expiry.next() == [2, 3]
+    assert await expiry.next() == [4, 102]
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(expiry.next(), 0.01)
+    assert await asyncio.wait_for(expiry.next(), 0.1) == [5]
+    assert len(loads) == 4
+
+    # the heap doesn't grow beyond a page, the rest is loaded later
+    for i in range(6, 10):
+        entries.append((now + timedelta(seconds=0.1), i))
+        expiry.add(*entries[-1])
+    assert len(expiry._heap) == 2
+    assert await asyncio.wait_for(expiry.next(), 0.2) == [6, 7]
+    assert await asyncio.wait_for(expiry.next(), 0.2) == [8, 9]
@@ -1,6 +1,7 @@
 import pytest
 from aiohttp import ClientSession
 
+from subscriber.models import Validators
 from subscriber.sources import Twitter, ChannelData, PostUpdate, Content
 
 
@@ -15,7 +16,9 @@ async def test_track():
 @pytest.mark.asyncio
 async def test_update():
     async with ClientSession() as session:
-        first = [x async for x in Twitter().update('https://twitter.com/jack', 'jack', session)][0]
+        first = [x async for x in Twitter().update(
+            'https://twitter.com/jack', 'jack', session, Validators(), lambda x: False
+        )][0]
     assert first == PostUpdate(id='jack/status/20', url='https://nitter.cz/jack/status/20#m', content=Content(
         description='RT by @jack: just setting up my twttr'
     ))
@@ -0,0 +1,166 @@
+import asyncio
+import hashlib
+import time
+
+import pytest
+from tarn import HashKeyStorage
+
+from subscriber import utils
+from subscriber.settings import config
+from subscriber.utils import (
+    HostLimiter, TokenBucket, TrackedQueue, acquire_tokens, get_domain, newest_entries, normalize_image, parse_feed,
+    store_stream, stream_feed
+)
+
+
+class StreamResponse:
+    def __init__(self, body: bytes, chunk_size: int):
+        self.chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+        self.read = 0
+        self.content = self
+
+    async def iter_chunked(self, n):
+        while self.read < len(self.chunks):
+            self.read += 1
+            yield self.chunks[self.read - 1]
+
+
+def make_feed(n):
+    entries = ''.join(
+        f'<entry><id>yt:video:{i}</id><title>Video &amp; {i}</title><link rel="alternate" href="https://y/{i}"/>'
+        f'<published>2023-01-{i + 1:02}T00:00:00+00:00</published></entry>'
+        for i in reversed(range(n))
+    )
+    return f'<?xml version="1.0"?><feed xmlns="http://www.w3.org/2005/Atom"><title>T</title>{entries}</feed>'.encode()
+
+
+def test_get_domain():
+    assert get_domain('https://www.YouTube.com/channel/123') == 'youtube.com'
+    assert get_domain('https://nitter.cz/jack/rss') == 'nitter.cz'
+
+
+@pytest.mark.asyncio
+async def test_host_limiter():
+    limiter = HostLimiter(3, 2)
+    active, peak = {}, {}
+
+    async def request(url):
+        domain = get_domain(url)
+        async with limiter(url):
+            active[domain] = active.get(domain, 0) + 1
+            peak[domain] = max(peak.get(domain, 0), active[domain])
+            peak['total'] = max(peak.get('total', 0), sum(active.values()))
+            await asyncio.sleep(0.01)
+            active[domain] -= 1
+
+    await asyncio.gather(*(
+        request(f'https://{host}/{i}') for i in range(5) for host in ['a.com', 'b.com']
+    ))
+    assert peak['a.com'] == peak['b.com'] == 2
+    assert peak['total'] == 3
+
+
+@pytest.mark.asyncio
+async def test_token_bucket():
+    fast, slow = TokenBucket(100), TokenBucket(20, 2)
+    start = time.monotonic()
+    for _ in range(5):
+        await acquire_tokens(fast)
+    assert 0.03 < time.monotonic() - start < 0.1
+
+    # the slowest bucket wins, after the initial burst
+    start = time.monotonic()
+    for _ in range(4):
+        await acquire_tokens(fast, slow)
+    assert 0.09 < time.monotonic() - start < 0.15
+
+    fast.pause(0.1)
+    assert not fast.full()
+    assert fast.delay() > 0.1
+
+
+@pytest.mark.asyncio
+async def test_tracked_queue():
+    queue = TrackedQueue('test', 4)
+    for i in range(4):
+        await queue.put(i)
+    assert queue.high_water == 4
+
+    # wait until half of the queue is consumed
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(queue.drained(), 0.01)
+    queue.get_nowait()
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(queue.drained(), 0.01)
+    queue.get_nowait()
+    await asyncio.wait_for(queue.drained(), 0.01)
+
+    await queue.put(4)
+    assert queue.high_water == 4
+
+
+@pytest.mark.asyncio
+async def test_stream_feed():
+    body = make_feed(20)
+    # the entries after the first `head` are parsed in the pool
+    assert [x async for x in stream_feed(StreamResponse(body, 100), 100, head=3)] == parse_feed(body)
+
+    # stop early
+    response = StreamResponse(body, 100)
+    async for entry in stream_feed(response, 100):
+        if entry['id'] == 'yt:video:17':
+            break
+    assert response.read < len(response.chunks) / 2
+
+    # not a feed
+    assert [x async for x in stream_feed(StreamResponse(b'<html><body></body></html>', 10), 10)] == []
+
+
+@pytest.mark.asyncio
+async def test_newest_entries():
+    async def ids(dates, known=()):
+        async def entries():
+            for i, date in enumerate(dates):
+                yield {'id': str(i), 'date': date}
+
+        return [x['id'] async for x in newest_entries(entries(), lambda x: x['id'] in known)]
+
+    # descending dates: stop at the first known entry
+    assert await ids([3, 2, 1, 0], {'2'}) == ['0', '1']
+    # oldest first: read everything and reverse
+    assert await ids([0, 1, 2], {'0'}) == ['2', '1', '0']
+    # no dates, equal dates or a pinned entry: the order is unknown, so read everything
+    assert await ids([None, None, None], {'1'}) == ['0', '1', '2']
+    assert await ids([1, 1, 1], {'1'}) == ['0', '1', '2']
+    assert await ids([3, 2, 4, 1], {'3'}) == ['0', '1', '2', '3']
+    assert sorted(await ids([0, 3, 2, 1], {'2'})) == ['0', '1', '2', '3']
+
+
+@pytest.mark.asyncio
+async def test_store_stream(tmp_path, monkeypatch):
+    storage = HashKeyStorage(tmp_path)
+    monkeypatch.setattr(utils, 'build_storage', lambda: storage)
+    body = make_feed(20)
+
+    for _ in range(2):
+        digest = await store_stream(StreamResponse(body, 100).iter_chunked(100))
+        assert digest == hashlib.sha256(body).hexdigest()
+        assert storage.read(lambda x: x.read_bytes(), digest) == body
+
+
+def test_normalize_image(tmp_path, monkeypatch):
+    Image = pytest.importorskip('PIL.Image')
+    source = tmp_path / 'image.png'
+    Image.effect_noise((1000, 500), 50).convert('RGBA').save(source)
+    assert normalize_image(source) == source
+
+    monkeypatch.setattr(config, 'image_max_size', 200)
+    result = normalize_image(source)
+    assert result.stat().st_size < source.stat().st_size
+    with Image.open(result) as image:
+        assert image.format == 'JPEG'
+        assert image.size == (200, 100)
+
+    # not an image
+    source.write_bytes(b'<svg></svg>')
+    assert normalize_image(source) == source
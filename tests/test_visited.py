@@ -0,0 +1,57 @@
+import pytest
+
+from subscriber.visited import VisitedIndex
+
+
+def test_eviction():
+    index = VisitedIndex(3)
+    visited = index[1]
+    for i in range(3):
+        visited.add(str(i))
+
+    # the known ids don't move
+    assert '0' in visited
+    visited.add('0')
+    visited.add('3')
+    visited.add('4')
+    assert len(visited) == 3
+    assert {'2', '3', '4'} == {x for x in map(str, range(5)) if x in visited}
+    assert '0' not in index[2]
+
+
+def test_save_load(tmp_path):
+    index = VisitedIndex(10)
+    index.update({1: ['a', 'b'], 2: ['c'], 3: []})
+    index.save(tmp_path / 'visited')
+
+    loaded = VisitedIndex.load(tmp_path / 'visited', 10)
+    assert 'a' in loaded[1] and 'b' in loaded[1] and 'c' not in loaded[1]
+    assert 'c' in loaded[2]
+    assert len(loaded[3]) == 0
+    assert set(loaded.memory()) == {1, 2, 3}
+
+
+def test_load_truncated(tmp_path):
+    index = VisitedIndex(10)
+    index.update({1: ['a', 'b']})
+    index.save(tmp_path / 'visited')
+    data = (tmp_path / 'visited').read_bytes()
+
+    for size in [len(data) - 8, 10]:
+        (tmp_path / 'visited').write_bytes(data[:size])
+        with pytest.raises(ValueError):
+            VisitedIndex.load(tmp_path / 'visited', 10)
+
+
+def test_dump_snapshot(tmp_path):
+    index = VisitedIndex(10)
+    index.update({1: ['a']})
+    snapshot = index.snapshot()
+    # later changes don't affect the snapshot
+    index.update({1: ['b'], 2: ['c']})
+    VisitedIndex.dump(tmp_path / 'visited', snapshot)
+
+    loaded = VisitedIndex.load(tmp_path / 'visited', 10)
+    assert 'a' in loaded[1] and 'b' not in loaded[1]
+    assert len(loaded[2]) == 0
+    assert [path.name for path in tmp_path.iterdir()] == ['visited']